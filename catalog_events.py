@@ -0,0 +1,129 @@
+"""
+ワインテーブルの変更をコミット単位で通知する仕組み
+メモリ上に保持しているカタログ（レコメンデーション用の行列など）を
+データベースと同期させるために使用します。
+ワインテーブルを変更したトランザクションではcatalog_metaのバージョンを加算し、
+他のプロセス（import_data.py --sync、flask convert-sweetnessなど）による更新も検出できるようにします。
+"""
+from datetime import datetime
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy.orm import Session, object_session
+from models import CatalogMeta, CATALOG_META_ID, Wine, initial_catalog_version
+
+_listeners = []
+
+
+class WineChanges:
+    """1回のコミットで発生したワインテーブルの変更内容"""
+
+    def __init__(self):
+        self.upserted = set()  # 追加・更新されたワインID
+        self.deleted = set()   # 削除されたワインID
+        self.full = False      # 一括更新などで対象IDが特定できない場合はTrue
+
+    def __bool__(self):
+        return self.full or bool(self.upserted) or bool(self.deleted)
+
+
+def on_wine_change(callback):
+    """ワインテーブルの変更がコミットされた時に呼ばれるコールバックを登録"""
+    _listeners.append(callback)
+    return callback
+
+
+def notify_wine_change(changes=None):
+    """登録済みのコールバックに変更を通知（引数なしの場合は全件変更として扱う）"""
+    if changes is None:
+        changes = WineChanges()
+        changes.full = True
+    for callback in _listeners:
+        callback(changes)
+
+
+def wine_fingerprint(session):
+    """
+    ワインテーブルの件数・最大ID（取り込み元からなくなったワインを除く）とカタログのバージョン
+    他のプロセスによる追加・更新・削除を検出するための軽量な集計
+    """
+    version = select(CatalogMeta.version).where(CatalogMeta.id == CATALOG_META_ID).scalar_subquery()
+    return tuple(session.query(func.count(Wine.id), func.max(Wine.id), version)
+                 .filter(Wine.retired_at.is_(None)).one())
+
+
+def bump_catalog_version(session):
+    """カタログのバージョンを加算（行がなければ追加）。ワインテーブルを変更したトランザクション内で呼び出す"""
+    now = datetime.utcnow()
+    result = session.execute(
+        update(CatalogMeta).where(CatalogMeta.id == CATALOG_META_ID)
+        .values(version=CatalogMeta.version + 1, updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    if not result.rowcount:
+        session.execute(insert(CatalogMeta).values(id=CATALOG_META_ID, version=initial_catalog_version(),
+                                                   updated_at=now))
+
+
+def _pending_changes(session):
+    return session.info.setdefault('wine_changes', WineChanges())
+
+
+def mark_wine_table_changed(session):
+    """セッションのイベントで検出できない変更（COPYなど）を行った場合に呼び出し、コミット時に全件変更として通知する"""
+    _pending_changes(session).full = True
+
+
+def _on_upsert(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        _pending_changes(session).upserted.add(target.id)
+
+
+def _on_delete(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        _pending_changes(session).deleted.add(target.id)
+
+
+def _on_execute(orm_execute_state):
+    # Query.update()/delete()やinsert()文など、ORMオブジェクトを経由しない変更
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    # update(Wine)などORMのエンティティを指定した文のtableは注釈付きのコピーのため、テーブル名で比較する
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if getattr(table, 'name', None) != Wine.__table__.name:
+        return
+    if orm_execute_state.is_insert:
+        _pending_changes(orm_execute_state.session).full = True
+        return
+    # 一致する行がなかったUPDATE/DELETE（データ修正の空のバッチなど）は変更として扱わない
+    # 主キーごとの一括UPDATEの結果には件数がないため、変更ありとして扱う
+    result = orm_execute_state.invoke_statement()
+    if getattr(result, 'rowcount', None) != 0:
+        _pending_changes(orm_execute_state.session).full = True
+    return result
+
+
+def _on_before_commit(session):
+    # ORMオブジェクトの変更はコミット時のflushで検出されるため、先にflushしてから確認する
+    session.flush()
+    if session.info.get('wine_changes'):
+        bump_catalog_version(session)
+
+
+def _on_commit(session):
+    changes = session.info.pop('wine_changes', None)
+    if changes:
+        notify_wine_change(changes)
+
+
+def _on_rollback(session):
+    session.info.pop('wine_changes', None)
+
+
+event.listen(Wine, 'after_insert', _on_upsert)
+event.listen(Wine, 'after_update', _on_upsert)
+event.listen(Wine, 'after_delete', _on_delete)
+event.listen(Session, 'do_orm_execute', _on_execute)
+event.listen(Session, 'before_commit', _on_before_commit)
+event.listen(Session, 'after_commit', _on_commit)
+event.listen(Session, 'after_rollback', _on_rollback)
@@ -0,0 +1,259 @@
+"""
+ワインカタログの一括読み込み
+ソース（CSV・SQLiteなど）をチャンク単位で読み込み、チャンクごとにCoreのinsert（executemany、
+PostgreSQLではCOPY）で追加してコミットします。保持するのは1チャンク分の行だけなので、
+カタログの件数が増えてもメモリ使用量は変わりません。
+
+sync_winesは既存のカタログとの差分だけを反映します。ワインはワイン名で対応付け、
+内容のハッシュ（content_hash）が変わったワインのみ更新し、取り込み元からなくなったワインは
+評価履歴を残すため削除せずにretired_atを設定します。変更のないワインのIDはそのまま保たれます。
+
+parse_chunksはCSVの解析などCPUを使う変換をプロセスプールで並列に行います。変換したチャンクは
+元の順序で書き込み側（1つのプロセス）に返されるため、読み込み結果はワーカー数によらず同じです。
+"""
+import hashlib
+import io
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from sqlalchemy import insert, update
+from models import Wine, UserPreference
+from profiles import rebuild_profiles
+from catalog_events import mark_wine_table_changed
+from search_keys import wine_search_keys
+
+# 1回のinsert・コミットで扱う行数
+CHUNK_SIZE = 5000
+
+# ワインの列（id以外、検索キーはwine_rowsで設定）
+WINE_COLUMNS = ('name', 'variety', 'variety_sub1', 'variety_sub2', 'vintage', 'wine_type', 'price',
+                'acidity', 'tannin', 'body', 'sweetness')
+
+
+class LoadProgress:
+    """読み込んだ行数と速度（rows/sec）をチャンクごとに表示"""
+
+    def __init__(self, label='wines', action='Inserted'):
+        self.label = label
+        self.action = action
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    @property
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def add(self, count):
+        self.rows += count
+        print(f"{self.action} {self.rows} {self.label} ({self.rate:.0f} rows/sec)")
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.started
+        print(f"Loaded {self.rows} {self.label} in {elapsed:.1f}s ({self.rate:.0f} rows/sec)")
+
+
+def sqlite_chunks(connection, query, chunksize=CHUNK_SIZE):
+    """SQLite（sqlite3の接続）のクエリ結果を、列名 -> 値の辞書のリストとしてチャンクごとに返す"""
+    cursor = connection.execute(query)
+    columns = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        yield [dict(zip(columns, row)) for row in rows]
+
+
+def parse_chunks(parse, chunks, workers=1):
+    """
+    チャンクをparseで変換して元の順序で返す。workers > 1の場合はプロセスプールで並列に変換する
+    parseはワーカーから呼べるようモジュールの関数にする。変換待ちのチャンクはワーカー数の2倍までに抑える
+    """
+    if workers <= 1:
+        yield from map(parse, chunks)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(parse, chunk))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # 書き込み側でエラーが起きた場合などは、まだ始まっていない変換を取り消す
+            for future in pending:
+                future.cancel()
+
+
+def content_hash(row):
+    """ワインの列の値から計算する内容のハッシュ（同じ内容なら常に同じ値）"""
+    values = json.dumps([row[column] for column in WINE_COLUMNS], ensure_ascii=False, default=str)
+    return hashlib.sha256(values.encode('utf-8')).hexdigest()
+
+
+def _wine_row(record):
+    """Wineの列の辞書をinsert用の行にする（ない列はNone、idは指定した場合のみ）。内容のハッシュを含む"""
+    row = {column: record.get(column) for column in WINE_COLUMNS}
+    if record.get('id') is not None:
+        row['id'] = record['id']
+    row['content_hash'] = content_hash(row)
+    return row
+
+
+def _set_search_keys(row):
+    # Coreのinsert・updateでは保存時のイベントが動かないため、検索キーをここで設定する
+    row.update(wine_search_keys(row['name'], row['variety'], row['variety_sub1'], row['variety_sub2']))
+    return row
+
+
+def wine_rows(records):
+    """Wineの列の辞書をinsert用の行（検索キーと内容のハッシュを含む）にする"""
+    return [_set_search_keys(_wine_row(record)) for record in records]
+
+
+def _copy_value(value):
+    # 文字列は常に引用符で囲み、NULL（引用符なしの空欄）と空文字列を区別する
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+
+def _copy_rows(session, table, rows):
+    """PostgreSQLのCOPYで行を追加（psycopg2以外のドライバーではFalseを返す）"""
+    cursor = session.connection().connection.cursor()
+    try:
+        if not hasattr(cursor, 'copy_expert'):
+            return False
+        columns = list(rows[0])
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(','.join(_copy_value(row[column]) for column in columns))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        return True
+    finally:
+        cursor.close()
+
+
+def insert_rows(session, table, rows):
+    """行（列名 -> 値の辞書、すべて同じ列）をまとめて追加する。コミットは呼び出し側で行う"""
+    if not rows:
+        return
+    if session.get_bind().dialect.name == 'postgresql' and _copy_rows(session, table, rows):
+        if table is Wine.__table__:
+            mark_wine_table_changed(session)
+        return
+    session.execute(insert(table), rows)
+
+
+def load_rows(session, table, chunks, progress=None):
+    """チャンク（行のリスト）ごとに追加してコミットし、追加した行数を返す"""
+    count = 0
+    for rows in chunks:
+        if not rows:
+            continue
+        insert_rows(session, table, rows)
+        session.commit()
+        count += len(rows)
+        if progress is not None:
+            progress.add(len(rows))
+    return count
+
+
+def load_wines(session, chunks, progress=None):
+    """Wineの列の辞書のチャンクをチャンクごとに追加してコミットし、追加した件数を返す"""
+    return load_rows(session, Wine.__table__, (wine_rows(records) for records in chunks), progress)
+
+
+class SyncResult:
+    """カタログの同期で追加・更新・変更なし・除外したワインの件数"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.retired = 0
+
+    def __str__(self):
+        return (f"{self.inserted} inserted, {self.updated} updated, "
+                f"{self.unchanged} unchanged, {self.retired} retired")
+
+
+def _existing_wines(session):
+    """ワイン名 -> [(ID, 内容のハッシュ, 除外済みか), ...]（同じ名前のワインはIDの順）"""
+    existing = {}
+    rows = session.query(Wine.id, Wine.name, Wine.content_hash, Wine.retired_at).order_by(Wine.id)
+    for wine_id, name, digest, retired_at in rows.yield_per(CHUNK_SIZE):
+        existing.setdefault(name, []).append((wine_id, digest, retired_at is not None))
+    return existing
+
+
+def _ids_in_batches(ids, size=CHUNK_SIZE):
+    ids = sorted(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def sync_wines(session, chunks, progress=None, retire=True):
+    """
+    Wineの列の辞書のチャンクを既存のカタログと比較し、追加・変更されたワインのみをチャンクごとに反映する
+    retire=Trueの場合、取り込み元にないワインにretired_atを設定する（取り込み元に戻ると除外を解除）
+    内容が変わったワインを評価したデバイスがあれば好みプロファイルを再計算し、SyncResultを返す
+    """
+    result = SyncResult()
+    existing = _existing_wines(session)
+    seen = Counter()  # ワイン名 -> 取り込み元での出現回数
+    changed_ids = set()
+    for records in chunks:
+        inserts = []
+        updates = []
+        for row in map(_wine_row, records):
+            # 同じ名前のワインは取り込み元での出現順とIDの順で対応付ける
+            occurrence = seen[row['name']]
+            seen[row['name']] += 1
+            matches = existing.get(row['name'], ())
+            if occurrence >= len(matches):
+                row.pop('id', None)
+                inserts.append(_set_search_keys(row))
+                continue
+            wine_id, digest, retired = matches[occurrence]
+            if digest == row['content_hash'] and not retired:
+                result.unchanged += 1
+                continue
+            row.pop('id', None)
+            updates.append({'id': wine_id, **_set_search_keys(row), 'retired_at': None})
+            changed_ids.add(wine_id)
+        insert_rows(session, Wine.__table__, inserts)
+        if updates:
+            session.execute(update(Wine), updates)
+        session.commit()
+        result.inserted += len(inserts)
+        result.updated += len(updates)
+        if progress is not None:
+            progress.add(len(records))
+
+    if retire:
+        now = datetime.utcnow()
+        retired_ids = [wine_id for name, matches in existing.items()
+                       for wine_id, _, retired in matches[seen[name]:] if not retired]
+        for batch in _ids_in_batches(retired_ids):
+            session.execute(update(Wine).where(Wine.id.in_(batch)).values(retired_at=now))
+            session.commit()
+        result.retired = len(retired_ids)
+
+    # 特徴量が変わったワインの評価は好みプロファイルの累積和に含まれているため、再計算する
+    for batch in _ids_in_batches(changed_ids):
+        if session.query(UserPreference.id).filter(UserPreference.wine_id.in_(batch)).first() is not None:
+            rebuild_profiles()
+            session.commit()
+            break
+    return result
@@ -0,0 +1,80 @@
+"""
+ワインデータの一括修正
+修正が必要な行をSQLのUPDATE ... CASEで主キーの範囲ごとにまとめて更新します。
+ワインをORMに読み込まないため、メモリ使用量はワインの件数によらず一定です。
+"""
+from sqlalchemy import and_, case, func, or_, update
+from models import UserPreference, Wine
+from profiles import rebuild_profiles
+
+# 1回のUPDATEで対象にする主キーの範囲
+BATCH_SIZE = 5000
+
+# SWEET形式の甘さ -> 数値（それ以外の文字列は3.0）
+SWEETNESS_LABELS = {
+    'SWEET1': 1.0,
+    'SWEET2': 2.0,
+    'SWEET3': 3.0,
+    'SWEET4': 4.0,
+    'SWEET5': 5.0,
+}
+DEFAULT_SWEETNESS = 3.0
+
+
+def update_wines_in_batches(session, values, condition, batch_size=BATCH_SIZE):
+    """
+    conditionに一致するワインをvalues（列 -> SQL式）で主キーの範囲ごとに更新してコミットし、更新した件数を返す
+    一致するワインがなければ何もしない。特徴量が変わるため、評価があれば好みプロファイルを再計算する
+    """
+    low, high = session.query(func.min(Wine.id), func.max(Wine.id)).filter(condition).one()
+    if low is None:
+        return 0
+
+    count = 0
+    for start in range(low, high + 1, batch_size):
+        statement = (
+            update(Wine)
+            .where(Wine.id >= start, Wine.id < start + batch_size, condition)
+            .values(values)
+            .execution_options(synchronize_session=False)
+        )
+        count += session.execute(statement).rowcount
+        session.commit()
+
+    if count and session.query(UserPreference.id).first() is not None:
+        rebuild_profiles()
+        session.commit()
+    return count
+
+
+def convert_sweetness_labels(session):
+    """
+    甘さがSWEET1～SWEET5の文字列で保存されているワインを1.0～5.0に変換し、更新した件数を返す
+    Float列に文字列が入るのはSQLiteのみのため、他のデータベースでは何もしない
+    """
+    if session.get_bind().dialect.name != 'sqlite':
+        return 0
+    sweetness = case(SWEETNESS_LABELS, value=Wine.sweetness, else_=DEFAULT_SWEETNESS)
+    return update_wines_in_batches(session, {Wine.sweetness: sweetness},
+                                   func.typeof(Wine.sweetness) == 'text')
+
+
+def _round_half_even(column):
+    # Pythonのround()と同じく、ちょうど.5の値は偶数に丸める（SQLのROUNDは0から遠い方に丸める）
+    is_half = and_(func.round(column * 2) == column * 2, func.round(column) != column)
+    return case((is_half, func.round(column / 2) * 2), else_=func.round(column))
+
+
+def normalize_sweetness(session):
+    """
+    甘さを1～5の整数値に揃え、更新した件数を返す
+    空・0は3.0、1未満は1.0、5より大きい値は5.0、それ以外は四捨五入（偶数丸め）
+    """
+    sweetness = case(
+        (or_(Wine.sweetness.is_(None), Wine.sweetness == 0), DEFAULT_SWEETNESS),
+        (Wine.sweetness < 1, 1.0),
+        (Wine.sweetness > 5, 5.0),
+        else_=_round_half_even(Wine.sweetness),
+    )
+    return update_wines_in_batches(session, {Wine.sweetness: sweetness},
+                                   Wine.sweetness.is_distinct_from(sweetness))
@@ -0,0 +1,116 @@
+"""
+データベースごとのエンジン設定
+DATABASE_URLからSQLiteかサーバー型（MySQL/PostgreSQL）かを判定し、
+SQLiteでは接続ごとにPRAGMA（WAL、synchronousなど）を設定し、
+サーバー型ではコネクションプールの大きさ・再接続・死活確認を設定します。
+すべての設定は環境変数で上書きできます。
+"""
+import os
+import re
+from sqlalchemy import event
+
+# PRAGMA名 -> (環境変数, デフォルト値)
+SQLITE_PRAGMAS = {
+    'journal_mode': ('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': ('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': ('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),   # バイト
+    'cache_size': ('SQLITE_CACHE_SIZE', -64 * 1024),         # 負の値はKiB単位
+    'busy_timeout': ('SQLITE_BUSY_TIMEOUT_MS', 5000),        # ミリ秒
+}
+
+# create_engineのオプション -> (環境変数, デフォルト値)
+POOL_OPTIONS = {
+    'pool_size': ('DB_POOL_SIZE', 5),
+    'max_overflow': ('DB_MAX_OVERFLOW', 10),
+    'pool_timeout': ('DB_POOL_TIMEOUT', 30),       # 秒
+    'pool_recycle': ('DB_POOL_RECYCLE', 1800),     # 秒（MySQLのwait_timeoutより短くする）
+    'pool_pre_ping': ('DB_POOL_PRE_PING', True),
+}
+
+# PRAGMAの値として受け付ける文字列（WAL、NORMAL、-65536など）
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+
+def normalize_database_url(database_url, base_dir):
+    """
+    DATABASE_URLの表記の違いを吸収する
+    postgres://はpostgresql://に置き換え、SQLiteの相対パスはbase_dirからの絶対パスにする
+    """
+    # If using Postgres in production (common for cloud platforms)
+    if database_url.startswith("postgres://"):
+        database_url = database_url.replace("postgres://", "postgresql://", 1)
+    # If using SQLite (easier for initial deployment)
+    elif database_url.startswith("sqlite://"):
+        sqlite_path = database_url.replace("sqlite:///", "", 1)
+        # Make path absolute for SQLite if it's not already
+        if not os.path.isabs(sqlite_path):
+            sqlite_path = os.path.join(base_dir, sqlite_path)
+        database_url = f"sqlite:///{sqlite_path}"
+    return database_url
+
+
+def is_sqlite(database_url):
+    return database_url.startswith('sqlite')
+
+
+def is_memory_sqlite(database_url):
+    return database_url in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in database_url
+
+
+def _setting(env_name, default, environ):
+    """環境変数の値をデフォルト値と同じ型に変換して返す"""
+    value = environ.get(env_name)
+    if value is None or value == '':
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'on', 'yes')
+    if isinstance(default, int):
+        return int(value)
+    return value
+
+
+def sqlite_pragmas(database_url, environ=None):
+    """接続ごとに設定するPRAGMA（環境変数で空文字以外を指定すると上書き、'off'で設定しない）"""
+    environ = os.environ if environ is None else environ
+    pragmas = {}
+    for name, (env_name, default) in SQLITE_PRAGMAS.items():
+        if environ.get(env_name, '').lower() == 'off':
+            continue
+        value = _setting(env_name, default, environ)
+        if not PRAGMA_VALUE.match(str(value)):
+            raise ValueError(f"Invalid value for {env_name}: {value}")
+        pragmas[name] = value
+    # インメモリのデータベースではWALとmmapは使えない
+    if is_memory_sqlite(database_url):
+        pragmas.pop('journal_mode', None)
+        pragmas.pop('mmap_size', None)
+    return pragmas
+
+
+def engine_options(database_url, environ=None):
+    """SQLALCHEMY_ENGINE_OPTIONS（SQLiteはPRAGMAで設定するため空）"""
+    if is_sqlite(database_url):
+        return {}
+    environ = os.environ if environ is None else environ
+    return {name: _setting(env_name, default, environ) for name, (env_name, default) in POOL_OPTIONS.items()}
+
+
+def install_sqlite_pragmas(engine, pragmas):
+    """新しい接続ごとにPRAGMAを実行するイベントを登録"""
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+
+def configure_engines(app, db, environ=None):
+    """Flask-SQLAlchemyが作成したエンジン（バインドを含む）にデータベースごとの設定を適用"""
+    with app.app_context():
+        for engine in db.engines.values():
+            url = engine.url.render_as_string(hide_password=False)
+            if is_sqlite(url):
+                install_sqlite_pragmas(engine, sqlite_pragmas(url, environ))
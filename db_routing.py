@@ -0,0 +1,111 @@
+"""
+読み取り専用のリクエストのレプリカへの振り分け
+DATABASE_REPLICA_URLを設定すると、読み取り専用のエンドポイントとカタログの読み込みはレプリカのエンジンを使い、
+書き込み（flush・INSERT/UPDATE/DELETE文）は常にプライマリを使います。
+デバイスが書き込んだ直後は、レプリカへの反映の遅れで自分の評価が見えなくならないように
+一定時間（スティッキー期間）そのデバイスの読み取りもプライマリで行います。
+スティッキー期間は書き込みの応答で署名付きのCookieとしてクライアントにも渡すため、
+次のリクエストを別のワーカープロセスが処理しても判定できます。
+"""
+import threading
+import time
+from flask_sqlalchemy.session import Session
+from itsdangerous import BadSignature, Signer
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND_KEY = 'replica'
+
+# session.infoのキー（Trueの間、読み取りをレプリカに振り分ける）
+READ_REPLICA = 'read_replica'
+
+# 書き込んだデバイスIDとスティッキー期間の期限を署名して保持するCookie
+STICKY_COOKIE = 'primary_reads'
+
+
+class RoutingSession(Session):
+    """読み取り専用に指定されたセッションのSELECTをレプリカのエンジンで実行するセッション"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get(READ_REPLICA) and not self._flushing \
+                and not isinstance(clause, UpdateBase):
+            engine = self._db.engines.get(REPLICA_BIND_KEY)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    デバイスごとの最後の書き込み時刻を保持し、スティッキー期間中はプライマリで読み取る
+    secret_keyを指定した場合は、署名付きのCookie（sticky_cookie）に入れた期限でも判定する
+    """
+
+    def __init__(self, sticky_seconds=5.0, secret_key=None):
+        self.sticky_seconds = sticky_seconds
+        self._sticky_until = {}  # device_id -> プライマリで読み取る期限（time.monotonic()）
+        self._signer = Signer(secret_key, salt=STICKY_COOKIE) if secret_key else None
+        self._lock = threading.Lock()
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def mark_write(self, device_id):
+        """デバイスの書き込みを記録（書き込みのコミット後に呼び出す）"""
+        now = time.monotonic()
+        with self._lock:
+            # 期限切れのエントリを時々削除
+            if len(self._sticky_until) > 1024:
+                self._sticky_until = {key: until for key, until in self._sticky_until.items() if until > now}
+            self._sticky_until[device_id] = now + self.sticky_seconds
+
+    def is_sticky(self, device_id):
+        with self._lock:
+            until = self._sticky_until.get(device_id)
+            if until is None:
+                return False
+            if until <= time.monotonic():
+                del self._sticky_until[device_id]
+                return False
+            return True
+
+    def sticky_cookie(self, device_id):
+        """
+        書き込みの応答で設定するCookieの値（期限（UNIX時間のミリ秒）とデバイスIDの署名）
+        期限はワーカープロセス間で比較するためtime.time()で表す。secret_keyがなければNone
+        """
+        if self._signer is None:
+            return None
+        until = int((time.time() + self.sticky_seconds) * 1000)
+        return self._signer.sign(f'{until}:{device_id}').decode()
+
+    def is_sticky_cookie(self, device_id, cookie):
+        """Cookieが署名の正しいdevice_idのもので、期限内ならTrue"""
+        if self._signer is None or not cookie:
+            return False
+        try:
+            value = self._signer.unsign(cookie).decode()
+        except BadSignature:
+            return False
+        until, _, cookie_device_id = value.partition(':')
+        return cookie_device_id == device_id and int(until) > time.time() * 1000
+
+    def use_replica(self, session, device_id=None, cookie=None):
+        """
+        このセッション（リクエスト）の読み取りをレプリカに振り分ける
+        device_idが直近に書き込んだデバイスの場合（このプロセスの記録またはCookie）はプライマリのまま。
+        振り分けた場合はTrueを返す
+        """
+        if device_id is not None and (self.is_sticky(device_id) or self.is_sticky_cookie(device_id, cookie)):
+            self.primary_reads += 1
+            return False
+        session.info[READ_REPLICA] = True
+        self.replica_reads += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            sticky_devices = len(self._sticky_until)
+        return {
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+            'sticky_devices': sticky_devices,
+        }
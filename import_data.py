@@ -1,5 +1,8 @@
 import pandas as pd
 from app import app, db, Wine, UserPreference
+from models import TasteProfile
+from catalog_loader import CHUNK_SIZE, LoadProgress, load_wines, parse_chunks, sync_wines
+import argparse
 import os
 import csv
 import mysql.connector
@@ -18,104 +21,123 @@ def won_to_yen(won_price):
         return 0
     return round(float(won_price) * 0.0892)
 
-def import_wine_data():
+# 読み込むCSVファイル
+CSV_PATH = '../archive/wine_info.csv'
+
+def parse_wine_row(row):
+    """CSVの1行（列名 -> 値の辞書）をWineの列の辞書に変換"""
+    # 品種情報を取得（NaNを除外）
+    varieties = [
+        str(row['varieties1']) if pd.notna(row['varieties1']) else None,
+        str(row['varieties2']) if pd.notna(row['varieties2']) else None,
+        str(row['varieties3']) if pd.notna(row['varieties3']) else None
+    ]
+    # NaNでない品種のみをフィルタリング
+    varieties = [v for v in varieties if v is not None and v.lower() != 'nan']
+
+    # Convert price from KRW to JPY
+    price_won = clean_numeric(row.get('price', 0))
+    price_yen = won_to_yen(price_won)
+
+    # Convert sweetness to numeric value
+    sweetness_map = {
+        'SWEET1': 1,  # Very Dry
+        'SWEET2': 2,  # Dry
+        'SWEET3': 3,  # Medium
+        'SWEET4': 4,  # Sweet
+        'SWEET5': 5   # Very Sweet
+    }
+
+    sweet_value = row.get('sweet')
+    if pd.isna(sweet_value):
+        # ワインタイプに基づいてデフォルトの甘さを設定
+        wine_type = str(row.get('type', '')).lower()
+        if wine_type == 'red':
+            sweetness = 1  # 赤ワインは通常辛口
+        elif wine_type == 'white':
+            sweetness = 2  # 白ワインは通常やや辛口
+        elif wine_type == 'sparkling':
+            sweetness = 3  # スパークリングは中程度
+        else:
+            sweetness = 2  # その他は辛口をデフォルトに
+        print(f"Warning: Missing sweetness value for wine {row.get('name')} ({wine_type}). Using default: {sweetness}")
+    else:
+        sweetness = sweetness_map.get(sweet_value)
+        if sweetness is None:
+            print(f"Warning: Invalid sweetness value for wine {row.get('name')}: {sweet_value}")
+            sweetness = 2  # 不明な場合は辛口をデフォルトに
+
+    # 製造年を取得（NaNの場合はNone）
+    vintage = None
+    if 'year' in row and pd.notna(row['year']):
+        try:
+            vintage = int(row['year'])
+        except (ValueError, TypeError):
+            vintage = None
+
+    # ワインタイプを取得
+    wine_type = str(row['type']).lower() if pd.notna(row.get('type')) else 'unknown'
+    # タイプを標準化
+    if 'red' in wine_type:
+        wine_type = 'red'
+    elif 'white' in wine_type:
+        wine_type = 'white'
+    elif 'rose' in wine_type or 'rosé' in wine_type:
+        wine_type = 'rose'
+    elif 'sparkling' in wine_type:
+        wine_type = 'sparkling'
+    else:
+        wine_type = 'other'
+
+    return dict(
+        name=row['name'],
+        variety=varieties[0] if len(varieties) > 0 else None,
+        variety_sub1=varieties[1] if len(varieties) > 1 else None,
+        variety_sub2=varieties[2] if len(varieties) > 2 else None,
+        vintage=vintage,
+        wine_type=wine_type,
+        price=price_yen,
+        acidity=clean_numeric(row.get('acidity', 0.0)),
+        tannin=clean_numeric(row.get('tannin', 0.0)),
+        body=clean_numeric(row.get('body', 0.0)),
+        sweetness=sweetness
+    )
+
+def parse_wine_chunk(chunk):
+    """CSVのチャンク（DataFrame）をWineの列の辞書のリストに変換（プロセスプールのワーカーで実行される）"""
+    return [parse_wine_row(row) for row in chunk.to_dict('records')]
+
+def read_wine_chunks(csv_path=CSV_PATH, chunksize=CHUNK_SIZE, workers=1):
+    """CSVをチャンク単位で読み込み、Wineの列の辞書のリストを順に返す（workers > 1の場合は並列に変換）"""
+    return parse_chunks(parse_wine_chunk, pd.read_csv(csv_path, chunksize=chunksize), workers)
+
+def import_wine_data(sync=False, workers=1):
+    """
+    CSVからワインデータをインポートする
+    sync=Trueの場合は既存のデータを削除せず、追加・変更されたワインのみを反映し、
+    CSVにないワインは除外する（ワインのIDと評価はそのまま）
+    workers > 1の場合はCSVの変換をworkers個のプロセスで行う（書き込みはこのプロセスのみ）
+    """
     try:
         with app.app_context():
+            if sync:
+                progress = LoadProgress(action='Synced')
+                result = sync_wines(db.session, read_wine_chunks(workers=workers), progress)
+                progress.finish()
+                print(f"ワインデータの同期が完了しました: {result}")
+                return
+
             # 既存のデータを削除（外部キー制約を考慮）
+            # 好みプロファイルは評価の累積和のため、評価と同じトランザクションで削除する
             UserPreference.query.delete()
+            TasteProfile.query.delete()
             Wine.query.delete()
             db.session.commit()
             
-            # CSVファイルを読み込む
-            df = pd.read_csv('../archive/wine_info.csv')
-            
-            # 各行をデータベースに挿入
-            for _, row in df.iterrows():
-                # 品種情報を取得（NaNを除外）
-                varieties = [
-                    str(row['varieties1']) if pd.notna(row['varieties1']) else None,
-                    str(row['varieties2']) if pd.notna(row['varieties2']) else None,
-                    str(row['varieties3']) if pd.notna(row['varieties3']) else None
-                ]
-                # NaNでない品種のみをフィルタリング
-                varieties = [v for v in varieties if v is not None and v.lower() != 'nan']
-                
-                # Convert price from KRW to JPY
-                price_won = clean_numeric(row.get('price', 0))
-                price_yen = won_to_yen(price_won)
-                
-                # Convert sweetness to numeric value
-                sweetness_map = {
-                    'SWEET1': 1,  # Very Dry
-                    'SWEET2': 2,  # Dry
-                    'SWEET3': 3,  # Medium
-                    'SWEET4': 4,  # Sweet
-                    'SWEET5': 5   # Very Sweet
-                }
-                
-                sweet_value = row.get('sweet')
-                if pd.isna(sweet_value):
-                    # ワインタイプに基づいてデフォルトの甘さを設定
-                    wine_type = str(row.get('type', '')).lower()
-                    if wine_type == 'red':
-                        sweetness = 1  # 赤ワインは通常辛口
-                    elif wine_type == 'white':
-                        sweetness = 2  # 白ワインは通常やや辛口
-                    elif wine_type == 'sparkling':
-                        sweetness = 3  # スパークリングは中程度
-                    else:
-                        sweetness = 2  # その他は辛口をデフォルトに
-                    print(f"Warning: Missing sweetness value for wine {row.get('name')} ({wine_type}). Using default: {sweetness}")
-                else:
-                    sweetness = sweetness_map.get(sweet_value)
-                    if sweetness is None:
-                        print(f"Warning: Invalid sweetness value for wine {row.get('name')}: {sweet_value}")
-                        sweetness = 2  # 不明な場合は辛口をデフォルトに
-                
-                # 製造年を取得（NaNの場合はNone）
-                vintage = None
-                if 'year' in row and pd.notna(row['year']):
-                    try:
-                        vintage = int(row['year'])
-                    except (ValueError, TypeError):
-                        vintage = None
-                
-                # ワインタイプを取得
-                wine_type = str(row['type']).lower() if pd.notna(row.get('type')) else 'unknown'
-                # タイプを標準化
-                if 'red' in wine_type:
-                    wine_type = 'red'
-                elif 'white' in wine_type:
-                    wine_type = 'white'
-                elif 'rose' in wine_type or 'rosé' in wine_type:
-                    wine_type = 'rose'
-                elif 'sparkling' in wine_type:
-                    wine_type = 'sparkling'
-                else:
-                    wine_type = 'other'
-                
-                # Wineオブジェクトを作成
-                wine = Wine(
-                    name=row['name'],
-                    variety=varieties[0] if len(varieties) > 0 else None,
-                    variety_sub1=varieties[1] if len(varieties) > 1 else None,
-                    variety_sub2=varieties[2] if len(varieties) > 2 else None,
-                    vintage=vintage,
-                    wine_type=wine_type,
-                    price=price_yen,
-                    acidity=clean_numeric(row.get('acidity', 0.0)),
-                    tannin=clean_numeric(row.get('tannin', 0.0)),
-                    body=clean_numeric(row.get('body', 0.0)),
-                    sweetness=sweetness
-                )
-                db.session.add(wine)
-
-                # 進捗表示
-                if _ % 100 == 0:
-                    print(f"Processed {_} wines")
-            
-            # 変更を保存
-            db.session.commit()
+            # CSVファイルをチャンク単位で読み込み、チャンクごとに一括で挿入してコミット
+            progress = LoadProgress()
+            load_wines(db.session, read_wine_chunks(workers=workers), progress)
+            progress.finish()
             print("ワインデータのインポートが完了しました")
             
     except Exception as e:
@@ -123,5 +145,11 @@ def import_wine_data():
         db.session.rollback()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CSVからワインデータをインポート')
+    parser.add_argument('--sync', action='store_true',
+                        help='既存のデータを削除せず、変更されたワインのみを反映する（評価は残る）')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='CSVの変換に使うプロセス数（デフォルト: 1）')
+    args = parser.parse_args()
     with app.app_context():
-        import_wine_data()
+        import_wine_data(sync=args.sync, workers=args.workers)
@@ -3,7 +3,7 @@ Database initialization script for Render deployment.
 This script will initialize the database with the required tables and import data.
 """
 from app import app, db, Wine, UserPreference
-import pandas as pd
+from catalog_loader import LoadProgress, load_rows, load_wines, sqlite_chunks
 import os
 import csv
 from datetime import datetime
@@ -25,44 +25,35 @@ def init_db():
                         import sqlite3
                         conn = sqlite3.connect('wine_database.db')
                         
-                        # Import wines
-                        wines_df = pd.read_sql('SELECT * FROM wine', conn)
-                        print(f"Found {len(wines_df)} wines to import from SQLite")
-                        
-                        for _, row in wines_df.iterrows():
-                            wine = Wine(
-                                id=row['id'],
-                                name=row['name'],
-                                variety=row['variety'],
-                                variety_sub1=row['variety_sub1'] if 'variety_sub1' in row else None,
-                                variety_sub2=row['variety_sub2'] if 'variety_sub2' in row else None,
-                                vintage=row['vintage'],
-                                wine_type=row['wine_type'],
-                                price=row['price'],
-                                acidity=row['acidity'],
-                                tannin=row['tannin'],
-                                body=row['body'],
-                                sweetness=row['sweetness']
-                            )
-                            db.session.add(wine)
+                        # Import wines（チャンク単位で読み込み、チャンクごとに一括で挿入してコミット）
+                        count = conn.execute('SELECT COUNT(*) FROM wine').fetchone()[0]
+                        print(f"Found {count} wines to import from SQLite")
+                        progress = LoadProgress()
+                        load_wines(db.session, sqlite_chunks(conn, 'SELECT * FROM wine'), progress)
+                        progress.finish()
                         
                         # Try to import user preferences if available
                         try:
-                            prefs_df = pd.read_sql('SELECT * FROM user_preferences', conn)
-                            print(f"Found {len(prefs_df)} user preferences to import")
+                            count = conn.execute('SELECT COUNT(*) FROM user_preferences').fetchone()[0]
+                            print(f"Found {count} user preferences to import")
+                            
+                            def preference_rows(records):
+                                return [{
+                                    'id': row['id'],
+                                    'wine_id': row['wine_id'],
+                                    'rating': row['rating'],
+                                    'rated_at': row['rated_at'] if isinstance(row['rated_at'], datetime) else datetime.now()
+                                } for row in records]
                             
-                            for _, row in prefs_df.iterrows():
-                                pref = UserPreference(
-                                    id=row['id'],
-                                    wine_id=row['wine_id'],
-                                    rating=row['rating'],
-                                    rated_at=row['rated_at'] if isinstance(row['rated_at'], datetime) else datetime.now()
-                                )
-                                db.session.add(pref)
+                            progress = LoadProgress('user preferences')
+                            load_rows(db.session, UserPreference.__table__,
+                                      (preference_rows(records) for records in
+                                       sqlite_chunks(conn, 'SELECT * FROM user_preferences')), progress)
+                            progress.finish()
                         except Exception as e:
                             print(f"No user preferences found or error importing them: {str(e)}")
+                            db.session.rollback()
                         
-                        db.session.commit()
                         print("Data import from SQLite completed!")
                         conn.close()
                     except Exception as e:
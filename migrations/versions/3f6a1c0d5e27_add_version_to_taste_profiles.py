@@ -0,0 +1,26 @@
+"""Add version to taste_profiles
+
+Revision ID: 3f6a1c0d5e27
+Revises: 7c2d9e41b8f3
+Create Date: 2026-10-18 11:03:12.284519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a1c0d5e27'
+down_revision = '7c2d9e41b8f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('taste_profiles', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('taste_profiles', schema=None) as batch_op:
+        batch_op.drop_column('version')
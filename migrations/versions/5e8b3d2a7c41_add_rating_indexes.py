@@ -0,0 +1,97 @@
+"""Add indexes and (device_id, wine_id) uniqueness to user_preferences
+
+Revision ID: 5e8b3d2a7c41
+Revises: b84e2f6c9a15
+Create Date: 2026-10-18 16:02:33.418760
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8b3d2a7c41'
+down_revision = 'b84e2f6c9a15'
+branch_labels = None
+depends_on = None
+
+# 重複行の削除を1回のDELETEで行う件数
+DELETE_BATCH_SIZE = 500
+
+
+def _remove_duplicate_ratings(connection):
+    """
+    同じ(device_id, wine_id)の評価が複数ある場合は、最も新しい評価（rated_at, idが最大）のみを残す
+    MySQLは削除対象と同じテーブルをサブクエリで参照できないため、削除するIDを取得してから削除する
+    """
+    user_preferences = sa.table(
+        'user_preferences',
+        sa.column('id', sa.Integer), sa.column('wine_id', sa.Integer),
+        sa.column('rated_at', sa.DateTime), sa.column('device_id', sa.String),
+    )
+    taste_profiles = sa.table('taste_profiles', sa.column('device_id', sa.String))
+
+    duplicates = sa.select(user_preferences.c.device_id, user_preferences.c.wine_id).where(
+        user_preferences.c.device_id.isnot(None)
+    ).group_by(user_preferences.c.device_id, user_preferences.c.wine_id).having(sa.func.count() > 1).subquery()
+    rows = connection.execute(
+        sa.select(user_preferences.c.id, user_preferences.c.device_id, user_preferences.c.wine_id).join(
+            duplicates, sa.and_(user_preferences.c.device_id == duplicates.c.device_id,
+                                user_preferences.c.wine_id == duplicates.c.wine_id)
+        ).order_by(user_preferences.c.device_id, user_preferences.c.wine_id,
+                   user_preferences.c.rated_at.desc(), user_preferences.c.id.desc())
+    )
+
+    delete_ids = []
+    devices = set()
+    kept = None
+    for rating_id, device_id, wine_id in rows:
+        if (device_id, wine_id) == kept:
+            delete_ids.append(rating_id)
+            devices.add(device_id)
+        else:
+            kept = (device_id, wine_id)
+
+    for start in range(0, len(delete_ids), DELETE_BATCH_SIZE):
+        batch = delete_ids[start:start + DELETE_BATCH_SIZE]
+        connection.execute(user_preferences.delete().where(user_preferences.c.id.in_(batch)))
+
+    # 重複を含めて集計したプロファイルは削除し、評価履歴からの集計に戻す
+    devices = sorted(devices)
+    for start in range(0, len(devices), DELETE_BATCH_SIZE):
+        batch = devices[start:start + DELETE_BATCH_SIZE]
+        connection.execute(taste_profiles.delete().where(taste_profiles.c.device_id.in_(batch)))
+
+    if delete_ids:
+        print(f"Removed {len(delete_ids)} duplicate ratings from {len(devices)} devices")
+
+
+def upgrade():
+    connection = op.get_bind()
+
+    # device_idはマイグレーション外で追加された環境があるため、存在しない場合のみ追加
+    columns = {column['name'] for column in sa.inspect(connection).get_columns('user_preferences')}
+    if 'device_id' not in columns:
+        with op.batch_alter_table('user_preferences', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('device_id', sa.String(length=100), nullable=True))
+
+    _remove_duplicate_ratings(connection)
+
+    with op.batch_alter_table('user_preferences', schema=None) as batch_op:
+        batch_op.create_index('uq_user_preferences_device_id_wine_id', ['device_id', 'wine_id'], unique=True)
+        batch_op.create_index('ix_user_preferences_device_id_rated_at', ['device_id', 'rated_at'], unique=False)
+
+    with op.batch_alter_table('wine', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_wine_name'), ['name'], unique=False)
+        batch_op.create_index(batch_op.f('ix_wine_wine_type'), ['wine_type'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('wine', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_wine_wine_type'))
+        batch_op.drop_index(batch_op.f('ix_wine_name'))
+
+    with op.batch_alter_table('user_preferences', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_preferences_device_id_rated_at')
+        batch_op.drop_index('uq_user_preferences_device_id_wine_id')
+    # 削除した重複行と、既存の環境にあったdevice_id列はそのまま
@@ -0,0 +1,34 @@
+"""Add taste_profiles
+
+Revision ID: 7c2d9e41b8f3
+Revises: a339a631ee6d
+Create Date: 2026-10-18 10:12:40.512331
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2d9e41b8f3'
+down_revision = 'a339a631ee6d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('taste_profiles',
+    sa.Column('device_id', sa.String(length=100), nullable=False),
+    sa.Column('acidity_sum', sa.Float(), nullable=False),
+    sa.Column('tannin_sum', sa.Float(), nullable=False),
+    sa.Column('body_sum', sa.Float(), nullable=False),
+    sa.Column('sweetness_sum', sa.Float(), nullable=False),
+    sa.Column('total_weight', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('device_id')
+    )
+    # 既存の評価履歴からのプロファイル作成は `flask rebuild-profiles` で行う
+
+
+def downgrade():
+    op.drop_table('taste_profiles')
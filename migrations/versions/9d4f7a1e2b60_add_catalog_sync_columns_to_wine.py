@@ -0,0 +1,29 @@
+"""Add content hash and retired_at to wine for incremental catalog sync
+
+Revision ID: 9d4f7a1e2b60
+Revises: 5e8b3d2a7c41
+Create Date: 2026-10-18 18:24:51.302117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4f7a1e2b60'
+down_revision = '5e8b3d2a7c41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('wine', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('retired_at', sa.DateTime(), nullable=True))
+    # 既存のワインのハッシュは最初の同期（import_data.py --sync）で設定される（内容が同じならIDはそのまま）
+
+
+def downgrade():
+    with op.batch_alter_table('wine', schema=None) as batch_op:
+        batch_op.drop_column('retired_at')
+        batch_op.drop_column('content_hash')
@@ -0,0 +1,31 @@
+"""Add search keys to wine
+
+Revision ID: b84e2f6c9a15
+Revises: 3f6a1c0d5e27
+Create Date: 2026-10-18 13:41:07.905126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b84e2f6c9a15'
+down_revision = '3f6a1c0d5e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('wine', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_key', sa.String(length=400), nullable=True))
+        batch_op.add_column(sa.Column('variety_search_key', sa.String(length=400), nullable=True))
+        batch_op.create_index(batch_op.f('ix_wine_search_key'), ['search_key'], unique=False)
+    # 既存のワインの検索キーは `flask backfill-search-keys` で設定する
+
+
+def downgrade():
+    with op.batch_alter_table('wine', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_wine_search_key'))
+        batch_op.drop_column('variety_search_key')
+        batch_op.drop_column('search_key')
@@ -0,0 +1,36 @@
+"""Add catalog_meta for detecting catalog changes made by other processes
+
+Revision ID: c5a8e3f17d42
+Revises: 9d4f7a1e2b60
+Create Date: 2026-10-18 21:07:36.518204
+
+"""
+import time
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a8e3f17d42'
+down_revision = '9d4f7a1e2b60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    catalog_meta = op.create_table('catalog_meta',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # バージョンは現在時刻（ミリ秒）から始める（models.initial_catalog_version()と同じ）
+    op.bulk_insert(catalog_meta, [
+        {'id': 1, 'version': int(time.time() * 1000), 'updated_at': datetime.utcnow()},
+    ])
+
+
+def downgrade():
+    op.drop_table('catalog_meta')
@@ -0,0 +1,77 @@
+import time
+from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from sqlalchemy import event
+from db_routing import RoutingSession
+
+# 読み取り専用のリクエストはレプリカに振り分けられるセッション（db_routing.py）
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Models
+class Wine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False, index=True)
+    variety = db.Column(db.String(100))  # メイン品種
+    variety_sub1 = db.Column(db.String(100))  # サブ品種1
+    variety_sub2 = db.Column(db.String(100))  # サブ品種2
+    vintage = db.Column(db.Integer)  # 製造年
+    wine_type = db.Column(db.String(50), index=True)  # ワインタイプ（赤、白、ロゼ、スパークリング）
+    price = db.Column(db.Integer)
+    acidity = db.Column(db.Float)
+    tannin = db.Column(db.Float)
+    body = db.Column(db.Float)
+    sweetness = db.Column(db.Float)  # 文字列から数値に変更
+    search_key = db.Column(db.String(400), index=True)  # 検索用に正規化したワイン名
+    variety_search_key = db.Column(db.String(400))  # 検索用に正規化した品種（|区切り）
+    content_hash = db.Column(db.String(64))  # 取り込み元の内容のハッシュ（カタログの差分同期で変更の検出に使用）
+    retired_at = db.Column(db.DateTime)  # 取り込み元からなくなった日時（評価履歴のため削除せず、検索・レコメンデーションから除外）
+
+class UserPreference(db.Model):
+    __tablename__ = 'user_preferences'
+    __table_args__ = (
+        # 1デバイスにつき1ワイン1件の評価
+        db.Index('uq_user_preferences_device_id_wine_id', 'device_id', 'wine_id', unique=True),
+        # デバイスごとの評価履歴（新しい順）
+        db.Index('ix_user_preferences_device_id_rated_at', 'device_id', 'rated_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    wine_id = db.Column(db.Integer, db.ForeignKey('wine.id'), nullable=False)
+    rating = db.Column(db.Integer, nullable=False)
+    rated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    device_id = db.Column(db.String(100), nullable=True)  # デバイスIDを保存するフィールド
+    wine = db.relationship('Wine', backref=db.backref('preferences', lazy=True))
+
+class TasteProfile(db.Model):
+    """デバイスごとの好み（評価の二乗で重み付けした特徴量の累積和）"""
+    __tablename__ = 'taste_profiles'
+    device_id = db.Column(db.String(100), primary_key=True)
+    acidity_sum = db.Column(db.Float, nullable=False, default=0.0)
+    tannin_sum = db.Column(db.Float, nullable=False, default=0.0)
+    body_sum = db.Column(db.Float, nullable=False, default=0.0)
+    sweetness_sum = db.Column(db.Float, nullable=False, default=0.0)
+    total_weight = db.Column(db.Integer, nullable=False, default=0)  # 評価の二乗の合計
+    version = db.Column(db.Integer, nullable=False, default=1)  # 更新のたびに加算（キャッシュのキーに使用）
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class CatalogMeta(db.Model):
+    """
+    ワインカタログのバージョン（1行のみ）
+    ワインテーブルを変更したトランザクションで加算し、他のプロセスが更新を検出するために使う（catalog_events.py）
+    """
+    __tablename__ = 'catalog_meta'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+CATALOG_META_ID = 1
+
+def initial_catalog_version():
+    # テーブルを作り直した後のバージョンが以前の値と重ならないよう、現在時刻（ミリ秒）から始める
+    return int(time.time() * 1000)
+
+@event.listens_for(CatalogMeta.__table__, 'after_create')
+def insert_catalog_meta(table, connection, **kw):
+    """db.create_all()でテーブルを作成した時にバージョンの行を追加"""
+    connection.execute(table.insert().values(
+        id=CATALOG_META_ID, version=initial_catalog_version(), updated_at=datetime.utcnow()
+    ))
@@ -1,17 +1,50 @@
 import os
 import sys
+import time
+
+# コールドスタート（コンテナの起動）からの時間を計測
+_cold_start = time.perf_counter()
 
 # Add the parent directory to the path so we can import from the root
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
-from app import app
-from flask import Flask, jsonify
+from app import app, db, init_database, warm_caches
 from netlify_lambda_wsgi import make_wsgi_handler
 
+
+def _initialize():
+    """テーブルの作成と、検索インデックス・レコメンデーションのカタログの読み込み（コンテナごとに1回）"""
+    with app.app_context():
+        try:
+            init_database()
+            warm_caches()
+        except Exception as e:
+            # 失敗してもリクエスト時に読み込み直すため、関数の起動は止めない
+            print(f"Error during warm-up: {str(e)}")
+        finally:
+            db.session.remove()
+
+
+_initialize()
+
+# WSGIハンドラーはコンテナごとに1回だけ作成し、以降の呼び出しで再利用する
+wsgi_handler = make_wsgi_handler(app)
+
+_init_ms = (time.perf_counter() - _cold_start) * 1000
+_invocations = 0
+
+
 # Function to handle serverless function requests
 def handler(event, context):
-    # Create WSGI handler for Flask application
-    wsgi_handler = make_wsgi_handler(app)
-    
-    # Call the WSGI handler
-    return wsgi_handler(event, context)
+    global _invocations
+    _invocations += 1
+    cold = _invocations == 1
+    started = time.perf_counter()
+    try:
+        return wsgi_handler(event, context)
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if cold:
+            print(f"cold start: init {_init_ms:.1f} ms, request {elapsed_ms:.1f} ms")
+        else:
+            print(f"warm: request {elapsed_ms:.1f} ms (invocation {_invocations})")
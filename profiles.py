@@ -0,0 +1,182 @@
+"""
+デバイスごとの好みプロファイル
+評価の二乗で重み付けした特徴量の累積和と重みの合計をtaste_profilesテーブルに保持し、
+評価の追加・変更・削除のたびに差分だけを反映します。
+"""
+from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from models import db, Wine, UserPreference, TasteProfile
+from recommender import FEATURES
+
+SUM_COLUMNS = {feature: getattr(TasteProfile, f'{feature}_sum') for feature in FEATURES}
+
+
+def _complete_wines():
+    # 特徴量がすべて揃っているワインのみを好みの計算に使用
+    return [getattr(Wine, feature).isnot(None) for feature in FEATURES]
+
+
+def _aggregate_query(device_id=None):
+    """user_preferencesからデバイスごとの累積和を集計するクエリ"""
+    weight = UserPreference.rating * UserPreference.rating
+    query = db.session.query(
+        UserPreference.device_id,
+        *[func.sum(getattr(Wine, feature) * weight) for feature in FEATURES],
+        func.sum(weight)
+    ).join(Wine, Wine.id == UserPreference.wine_id).filter(
+        UserPreference.device_id.isnot(None), *_complete_wines()
+    )
+    if device_id is not None:
+        query = query.filter(UserPreference.device_id == device_id)
+    return query.group_by(UserPreference.device_id)
+
+
+def _averages(sums, total_weight):
+    if not total_weight:
+        return None
+    return {feature: sums[feature] / total_weight for feature in FEATURES}
+
+
+def get_profile(device_id):
+    """
+    デバイスの好み（特徴量の重み付き平均）を返す。評価がない場合はNone
+    プロファイルが未作成の場合は評価履歴から集計する（保存はしない）
+    """
+    profile = db.session.get(TasteProfile, device_id)
+    if profile is not None:
+        return _averages({feature: getattr(profile, f'{feature}_sum') for feature in FEATURES},
+                         profile.total_weight)
+
+    row = _aggregate_query(device_id).first()
+    if row is None:
+        return None
+    return _averages(dict(zip(FEATURES, row[1:-1])), row[-1])
+
+
+def apply_rating_change(device_id, wine_id, old_rating=None, new_rating=None):
+    """
+    評価の追加・変更・削除をプロファイルに反映（O(1)）
+    old_ratingがNoneなら追加、new_ratingがNoneなら削除として扱う
+    評価の書き込みと同じトランザクション内で呼び出し、コミットは呼び出し側で行う
+    """
+    apply_rating_changes(device_id, [(wine_id, old_rating, new_rating)])
+
+
+def apply_rating_changes(device_id, changes):
+    """
+    同じデバイスの複数の評価の変更（(wine_id, 以前の評価, 新しい評価)のリスト）をまとめてプロファイルに反映
+    ワインの特徴量の取得とプロファイルの更新はそれぞれ1回のクエリで行う
+    """
+    deltas = {}
+    for wine_id, old_rating, new_rating in changes:
+        delta = (int(new_rating) ** 2 if new_rating else 0) - (int(old_rating) ** 2 if old_rating else 0)
+        if delta:
+            deltas[wine_id] = deltas.get(wine_id, 0) + delta
+    if not deltas or device_id is None:
+        return
+
+    # 特徴量が揃っていないワインは累積和に含めないが、品種の好みは変わるためバージョンは加算する
+    wines = db.session.query(Wine.id, *[getattr(Wine, feature) for feature in FEATURES]).filter(
+        Wine.id.in_(deltas), *_complete_wines()
+    ).all()
+    total_delta = sum(deltas[wine[0]] for wine in wines)
+
+    # 同時に書き込まれても差分が失われないようにUPDATE文で加算
+    values = {
+        column: column + sum(wine[1 + i] * deltas[wine[0]] for wine in wines)
+        for i, column in enumerate(SUM_COLUMNS.values())
+    }
+    values[TasteProfile.total_weight] = TasteProfile.total_weight + total_delta
+    values[TasteProfile.version] = TasteProfile.version + 1
+    values[TasteProfile.updated_at] = datetime.utcnow()
+    updated = db.session.query(TasteProfile).filter(TasteProfile.device_id == device_id).update(
+        values, synchronize_session=False
+    )
+    if not updated:
+        # プロファイルが未作成の場合は評価履歴から作成（今回の変更も含まれる）
+        db.session.flush()
+        rebuild_profiles(device_id)
+
+
+def _insert_empty_profile(device_id):
+    """
+    評価のない空のプロファイル行を追加する（既にあれば何もしない）。追加した場合はTrueを返す
+    同時に追加しても主キーの衝突でエラーにならないよう、データベースのINSERT ... ON CONFLICT DO NOTHING
+    （MySQLはINSERT IGNORE）を使う
+    """
+    dialect = db.session.get_bind(mapper=TasteProfile).dialect.name
+    values = {column.key: 0.0 for column in SUM_COLUMNS.values()}
+    values.update(device_id=device_id, total_weight=0, version=0, updated_at=datetime.utcnow())
+    table = TasteProfile.__table__
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = insert(table).values(values).on_conflict_do_nothing(index_elements=['device_id'])
+    elif dialect in ('mysql', 'mariadb'):
+        statement = mysql.insert(table).values(values).prefix_with('IGNORE')
+    else:
+        raise NotImplementedError(f"Insert ignore is not supported for {dialect}")
+    return db.session.execute(statement).rowcount == 1
+
+
+def lock_profile(device_id):
+    """
+    同じデバイスの評価の書き込みを直列化するため、トランザクションの最初にプロファイル行をロックする
+    行がなければ先に空の行を追加してから、値を変えないUPDATEでサーバー型のデータベースでは行ロック、
+    SQLiteでは書き込みロックを取得する（初回の評価が同時に書き込まれても、後の書き込みは追加した行のロックを待つ）
+    空の行を追加した場合はTrueを返す。呼び出し側は評価の書き込み後にrebuild_profiles(device_id)で値を設定する
+    """
+    created = _insert_empty_profile(device_id)
+    db.session.query(TasteProfile).filter(TasteProfile.device_id == device_id).update(
+        {TasteProfile.version: TasteProfile.version}, synchronize_session=False
+    )
+    return created
+
+
+def profile_version(device_id):
+    """プロファイルのバージョン（未作成の場合はNone）"""
+    profile = db.session.get(TasteProfile, device_id)
+    return profile.version if profile is not None else None
+
+
+def rebuild_profiles(device_id=None):
+    """
+    user_preferencesからプロファイルを再計算（device_id省略時は全デバイス）
+    既存のプロファイルはバージョンを引き継いで加算する
+    特徴量が揃ったワインの評価がなくても評価が残っているデバイスは、累積和を0にしてプロファイルを残す
+    （バージョンがキャッシュのキーのため）
+    """
+    existing = db.session.query(TasteProfile)
+    if device_id is not None:
+        existing = existing.filter(TasteProfile.device_id == device_id)
+    existing = {profile.device_id: profile for profile in existing}
+
+    now = datetime.utcnow()
+    count = 0
+    for row in _aggregate_query(device_id):
+        profile = existing.pop(row[0], None)
+        if profile is None:
+            profile = TasteProfile(device_id=row[0], version=0)
+            db.session.add(profile)
+        for feature, value in zip(FEATURES, row[1:-1]):
+            setattr(profile, f'{feature}_sum', value)
+        profile.total_weight = row[-1]
+        profile.version += 1
+        profile.updated_at = now
+        count += 1
+
+    # 評価がなくなったデバイスのプロファイルは削除し、特徴量が揃ったワインの評価がないデバイスは累積和を0にする
+    rated = {row[0] for row in db.session.query(UserPreference.device_id).filter(
+        UserPreference.device_id.in_(list(existing))
+    ).distinct()} if existing else set()
+    for profile in existing.values():
+        if profile.device_id not in rated:
+            db.session.delete(profile)
+            continue
+        for column in SUM_COLUMNS.values():
+            setattr(profile, column.key, 0.0)
+        profile.total_weight = 0
+        profile.version += 1
+        profile.updated_at = now
+    db.session.flush()
+    return count
@@ -0,0 +1,117 @@
+"""
+デバイスごとの評価履歴
+評価とワインの列を1回の結合クエリで取得し、評価件数に関わらずクエリ数を一定に保ちます。
+ページングは(rated_at, id)のキーセット方式で、OFFSETを使わずに続きから取得します。
+"""
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+from models import db, Wine, UserPreference
+
+HISTORY_PAGE_LIMIT = 50
+HISTORY_MAX_LIMIT = 500
+
+# ストリーミング時にサーバーサイドカーソルから一度に取得する行数
+STREAM_BATCH_SIZE = 500
+
+# 評価履歴として返すワインの列
+RATED_WINE_COLUMNS = (
+    Wine.id, Wine.name, Wine.variety, Wine.variety_sub1, Wine.variety_sub2,
+    Wine.vintage, Wine.wine_type, Wine.price,
+)
+
+
+def encode_cursor(rated_at, rating_id):
+    """ページの最後の行の(rated_at, id)を次のページのカーソル文字列にする"""
+    payload = json.dumps([rated_at.isoformat(), rating_id]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """カーソル文字列を(rated_at, id)に戻す。不正な場合はValueError"""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        rated_at, rating_id = json.loads(payload)
+        return datetime.fromisoformat(rated_at), int(rating_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def rated_wines_query(device_id, cursor=None):
+    """
+    デバイスの評価履歴（新しい順）を評価とワインの必要な列だけで取得するクエリ
+    cursorを指定した場合はその行より後（古い方）から
+    """
+    query = db.session.query(
+        *RATED_WINE_COLUMNS,
+        UserPreference.rating,
+        UserPreference.rated_at,
+        UserPreference.device_id,
+        UserPreference.id.label('rating_id'),
+    ).join(Wine, Wine.id == UserPreference.wine_id).filter(
+        UserPreference.device_id == device_id
+    )
+    if cursor is not None:
+        rated_at, rating_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            UserPreference.rated_at < rated_at,
+            and_(UserPreference.rated_at == rated_at, UserPreference.id < rating_id),
+        ))
+    return query.order_by(UserPreference.rated_at.desc(), UserPreference.id.desc())
+
+
+def serialize_rated_wine(row, include_device_id=False):
+    """評価履歴の1行をAPIのレスポンス形式に変換"""
+    rated_wine = {
+        'id': row.id,
+        'name': row.name,
+        'variety': row.variety,
+        'variety_sub1': row.variety_sub1,
+        'variety_sub2': row.variety_sub2,
+        'vintage': row.vintage,
+        'wine_type': row.wine_type or 'other',
+        'price': row.price,
+        'rating': row.rating,
+        'rated_at': row.rated_at.isoformat() if row.rated_at else None,
+    }
+    if include_device_id:
+        rated_wine['device_id'] = row.device_id
+    return rated_wine
+
+
+def load_rated_wines(device_id, include_device_id=False):
+    """デバイスの評価履歴をレスポンス形式のリストで返す"""
+    return [serialize_rated_wine(row, include_device_id) for row in rated_wines_query(device_id)]
+
+
+def load_rated_wines_page(device_id, limit=HISTORY_PAGE_LIMIT, cursor=None, include_device_id=False):
+    """
+    評価履歴の1ページ分と次のページのカーソル（最後のページならNone）を返す
+    limit件より1件多く取得して続きの有無を判定する
+    """
+    if limit <= 0:
+        return [], None
+    rows = rated_wines_query(device_id, cursor).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].rated_at, rows[-1].rating_id)
+    return [serialize_rated_wine(row, include_device_id) for row in rows], next_cursor
+
+
+def stream_rated_wines(device_id, cursor=None, limit=None, include_device_id=False):
+    """
+    評価履歴をNDJSON（1行に1件のJSON）で順に生成するイテレータを返す
+    サーバーサイドカーソルからSTREAM_BATCH_SIZE件ずつ取得するため、履歴の件数に関わらずメモリ使用量は一定
+    カーソルの検証はレスポンスの送信前（呼び出し時）に行う
+    """
+    query = rated_wines_query(device_id, cursor)
+    if limit is not None:
+        query = query.limit(limit)
+    query = query.execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE)
+
+    def generate():
+        for row in query:
+            yield json.dumps(serialize_rated_wine(row, include_device_id), ensure_ascii=False) + '\n'
+    return generate()
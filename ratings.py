@@ -0,0 +1,127 @@
+"""
+評価の書き込み
+評価はデータベースのネイティブなupsert（SQLite/PostgreSQLはON CONFLICT、MySQLはON DUPLICATE KEY UPDATE）で
+1文で追加・更新し、(device_id, wine_id)のユニークインデックスにより同時書き込みでも重複しません。
+"""
+from datetime import datetime
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from models import db, Wine, UserPreference
+from profiles import apply_rating_changes, lock_profile, rebuild_profiles
+
+# upsertの衝突判定に使う列（uq_user_preferences_device_id_wine_id）
+RATING_KEY = ('device_id', 'wine_id')
+
+# 既存の評価がある場合に更新する列
+RATING_UPDATE_COLUMNS = ('rating', 'rated_at')
+
+RATING_MIN = 1
+RATING_MAX = 5
+
+# /rate_winesで1回に受け付ける評価の件数
+BULK_RATING_LIMIT = 500
+
+
+def upsert_statement():
+    """
+    使用中のデータベースに合わせたuser_preferencesのupsert文
+    値はexecuteのパラメータで渡す（リストを渡すとexecutemanyになる）
+    """
+    dialect = db.session.get_bind(mapper=UserPreference).dialect.name
+    table = UserPreference.__table__
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=list(RATING_KEY),
+            set_={column: statement.excluded[column] for column in RATING_UPDATE_COLUMNS},
+        )
+    if dialect in ('mysql', 'mariadb'):
+        statement = mysql.insert(table)
+        return statement.on_duplicate_key_update(
+            {column: statement.inserted[column] for column in RATING_UPDATE_COLUMNS}
+        )
+    raise NotImplementedError(f"Upsert is not supported for {dialect}")
+
+
+def current_ratings(device_id, wine_ids):
+    """現在の評価（wine_id -> (評価, 評価日時)）。サーバー型のデータベースでは行をロックして読み取る"""
+    rows = db.session.query(UserPreference.wine_id, UserPreference.rating, UserPreference.rated_at).filter(
+        UserPreference.device_id == device_id, UserPreference.wine_id.in_(wine_ids)
+    ).with_for_update()
+    return {wine_id: (rating, rated_at) for wine_id, rating, rated_at in rows}
+
+
+def existing_wine_ids(wine_ids):
+    """存在するワインIDの集合（1回のクエリで確認）"""
+    if not wine_ids:
+        return set()
+    return {row[0] for row in db.session.query(Wine.id).filter(Wine.id.in_(set(wine_ids)))}
+
+
+def save_ratings(device_id, ratings):
+    """
+    同じデバイスの複数の評価（wine_id, rating, rated_atの辞書のリスト、wine_idは重複なし）を
+    1回のupsert（executemany）で追加または更新し、好みプロファイルに差分をまとめて反映する
+    保存済みの評価よりrated_atが古い評価（オフラインで集めた評価の再送など）は保存しない
+    (以前の評価（wine_id -> 評価、なければ含まない）, 古いため保存しなかったwine_idの集合)を返す
+    コミットは呼び出し側で行う
+    """
+    if not ratings:
+        return {}, set()
+    # 以前の評価を読み取ってから差分を反映するまでの間に、同じデバイスの書き込みが割り込まないようにする
+    created = lock_profile(device_id)
+    current = current_ratings(device_id, [item['wine_id'] for item in ratings])
+    now = datetime.utcnow()
+    rows = []
+    stale = set()
+    for item in ratings:
+        # 未来の日時は現在時刻にする（以降の評価がすべて古い扱いにならないように）
+        rated_at = min(item.get('rated_at') or now, now)
+        if item['wine_id'] in current and rated_at < current[item['wine_id']][1]:
+            stale.add(item['wine_id'])
+            continue
+        rows.append({'device_id': device_id, 'wine_id': item['wine_id'], 'rating': item['rating'],
+                     'rated_at': rated_at})
+    old_ratings = {row['wine_id']: current[row['wine_id']][0] for row in rows if row['wine_id'] in current}
+    if rows:
+        db.session.execute(upsert_statement(), rows)
+    if created:
+        # 追加したばかりの空のプロファイルには、これまでの評価を含めて評価履歴から値を設定する
+        db.session.flush()
+        rebuild_profiles(device_id)
+    elif rows:
+        apply_rating_changes(device_id, [
+            (row['wine_id'], old_ratings.get(row['wine_id']), row['rating']) for row in rows
+        ])
+    return old_ratings, stale
+
+
+def save_rating(device_id, wine_id, rating):
+    """
+    評価を追加または更新し、好みプロファイルに差分を反映する。以前の評価（なければNone）を返す
+    コミットは呼び出し側で行う
+    """
+    old_ratings, _ = save_ratings(device_id, [{'wine_id': wine_id, 'rating': rating}])
+    return old_ratings.get(wine_id)
+
+
+def remove_rating(device_id, wine_id):
+    """
+    評価を削除し、好みプロファイルから差し引く。削除した評価（なければNone）を返す
+    save_ratingsと同じくプロファイル行をロックしてから現在の評価を読み取り、同時の書き込みで差分がずれないようにする
+    コミットは呼び出し側で行う
+    """
+    created = lock_profile(device_id)
+    current = current_ratings(device_id, [wine_id])
+    old_rating = current[wine_id][0] if wine_id in current else None
+    if old_rating is not None:
+        db.session.query(UserPreference).filter(
+            UserPreference.device_id == device_id, UserPreference.wine_id == wine_id
+        ).delete(synchronize_session=False)
+    if created:
+        # 追加したばかりの空のプロファイルには評価履歴から値を設定する
+        db.session.flush()
+        rebuild_profiles(device_id)
+    elif old_rating is not None:
+        apply_rating_changes(device_id, [(wine_id, old_rating, None)])
+    return old_rating
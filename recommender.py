@@ -0,0 +1,401 @@
+"""
+レコメンデーションエンジン
+ワインカタログの特徴量（酸味・タンニン・ボディ・甘さ）を行列として保持し、
+未評価の全候補ワインの類似度を1回のベクトル演算で計算します。
+"""
+import itertools
+import threading
+import time
+import numpy as np
+from models import Wine
+from catalog_events import on_wine_change, wine_fingerprint
+
+FEATURES = ('acidity', 'tannin', 'body', 'sweetness')
+
+# 特徴量の重要度
+FEATURE_WEIGHTS = {
+    'acidity': 1.5,    # 酸味（重要）
+    'tannin': 1.5,     # タンニン（重要）
+    'body': 1.0,       # ボディ（標準）
+    'sweetness': 1.0   # 甘さ（標準）
+}
+
+# 特徴量と品種の類似度の配分（9:1）
+FEATURE_SIMILARITY_RATIO = 0.9
+VARIETY_SIMILARITY_RATIO = 0.1
+
+# カタログを分割するワインタイプ
+WINE_TYPE_PARTITIONS = ('red', 'white', 'sparkling', 'rose', 'other')
+
+# レコメンデーションの表示区分（デフォルト）と件数
+RECOMMENDATION_TYPES = ('red', 'white', 'sparkling', 'other')
+RECOMMENDATION_LIMIT = 5
+RECOMMENDATION_MAX_LIMIT = 50
+
+# 品種の列（メイン品種、サブ品種1、サブ品種2）
+VARIETY_COLUMNS = ('variety', 'variety_sub1', 'variety_sub2')
+
+# サブ品種の重み（0の場合はメイン品種のみで類似度を計算）
+SUB_VARIETY_WEIGHT = 0.0
+
+# 他のプロセスによるカタログの変更を確認する間隔（秒、search_index.SYNC_INTERVALと同じ）
+CATALOG_CHECK_INTERVAL = 1.0
+
+# カタログとして読み込むWineの列
+WINE_COLUMNS = ('id', 'name', 'vintage', 'variety', 'variety_sub1', 'variety_sub2',
+                'price', 'wine_type', 'acidity', 'tannin', 'body', 'sweetness')
+
+# 近傍探索の方式（brute: 全件スキャン、kd_tree/ball_tree: 空間インデックス）
+INDEX_ALGORITHMS = ('brute', 'kd_tree', 'ball_tree')
+
+# 特徴量行列のdtype
+# float32にすると既存エンドポイントと類似度の下位桁が一致しなくなるためfloat64を使用
+FEATURE_DTYPE = np.float64
+
+
+def empty_recommendations(types=RECOMMENDATION_TYPES):
+    return {wine_type: [] for wine_type in types}
+
+
+def normalize_wine_type(wine_type):
+    """wine_typeを分割用のワインタイプ（red/white/sparkling/rose/other）に正規化"""
+    wine_type = wine_type.strip().lower() if wine_type else 'other'
+    if wine_type == 'rosé':
+        wine_type = 'rose'
+    return wine_type if wine_type in WINE_TYPE_PARTITIONS else 'other'
+
+
+def section_partitions(section, types):
+    """
+    表示区分に含めるパーティション
+    roseを個別に要求していない場合、ロゼはotherに含める（従来の表示と同じ）
+    """
+    if section == 'other' and 'rose' not in types:
+        return ('rose', 'other')
+    return (section,)
+
+
+def top_k(values, k):
+    """
+    値の大きい順に上位k件の添字を返す（同じ値の場合は添字の小さい順）
+    全件をソートせず、k番目の値以上の要素だけを並べ替える
+    """
+    if len(values) > k:
+        threshold = np.partition(values, len(values) - k)[len(values) - k]
+        candidates = np.flatnonzero(values >= threshold)
+    else:
+        candidates = np.arange(len(values))
+    order = np.argsort(-values[candidates], kind='stable')[:k]
+    return candidates[order]
+
+
+class WineCatalog:
+    """ワインテーブルのスナップショット（ID順）"""
+
+    def __init__(self, rows, fingerprint=None, version=0):
+        self.rows = rows
+        self.fingerprint = fingerprint
+        self.version = version
+        self.ids = np.array([row.id for row in rows], dtype=np.int64)
+
+        features = np.array(
+            [[np.nan if getattr(row, f) is None else getattr(row, f) for f in FEATURES] for row in rows],
+            dtype=FEATURE_DTYPE
+        ).reshape(len(rows), len(FEATURES))
+        # 特徴量がすべて揃っているワインのみをレコメンデーション対象にする
+        self.complete = ~np.isnan(features).any(axis=1)
+        # 1-5の範囲を0-1に正規化
+        self.normalized = (features - 1) / 4
+
+        # 品種は整数IDに変換して保持（メイン・サブ1・サブ2、品種なしは-1）
+        self.variety_ids = {}
+        self.variety_codes = np.array(
+            [[self._variety_code(getattr(row, column)) for column in VARIETY_COLUMNS] for row in rows],
+            dtype=np.int32
+        ).reshape(len(rows), len(VARIETY_COLUMNS))
+
+        # ワインタイプごとのパーティション（特徴量が揃っているワインの行番号、ID順）
+        wine_types = np.array([normalize_wine_type(row.wine_type) for row in rows], dtype=object)
+        self.partitions = {
+            wine_type: np.flatnonzero(self.complete & (wine_types == wine_type))
+            for wine_type in WINE_TYPE_PARTITIONS
+        }
+        self.partition_of = wine_types
+        # 近傍探索インデックス（方式ごとに初回利用時に構築）
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+
+    def _variety_code(self, variety):
+        if not variety:
+            return -1
+        return self.variety_ids.setdefault(variety, len(self.variety_ids))
+
+    @classmethod
+    def load(cls, session, fingerprint=None, version=0):
+        columns = [getattr(Wine, column) for column in WINE_COLUMNS]
+        rows = session.query(*columns).filter(Wine.retired_at.is_(None)).order_by(Wine.id).all()
+        return cls(rows, fingerprint, version)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def positions(self, wine_ids):
+        """ワインIDのリストをカタログ内の行番号に変換（存在しないIDは-1）"""
+        wine_ids = np.asarray(wine_ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, wine_ids)
+        positions[positions >= len(self.ids)] = 0
+        found = self.ids[positions] == wine_ids if len(self.ids) else np.zeros(len(wine_ids), dtype=bool)
+        return np.where(found, positions, -1)
+
+    def members(self, partitions):
+        """指定したパーティションに属する行番号（ID順）"""
+        if len(partitions) == 1:
+            return self.partitions[partitions[0]]
+        return np.sort(np.concatenate([self.partitions[p] for p in partitions]))
+
+    def index(self, algorithm):
+        """近傍探索インデックスを取得（カタログと同じく変更時に作り直される）"""
+        index = self._indexes.get(algorithm)
+        if index is None:
+            with self._index_lock:
+                index = self._indexes.get(algorithm)
+                if index is None:
+                    index = self._indexes[algorithm] = TasteIndex(self, algorithm)
+        return index
+
+    def to_dict(self, position, similarity):
+        row = self.rows[position]
+        return {
+            'id': row.id,
+            'name': row.name,
+            'vintage': row.vintage,
+            'variety': row.variety,
+            'variety_sub1': row.variety_sub1,
+            'variety_sub2': row.variety_sub2,
+            'price': row.price,
+            'wine_type': row.wine_type,
+            'similarity': float(similarity),
+            'acidity': row.acidity,
+            'tannin': row.tannin,
+            'body': row.body,
+            'sweetness': row.sweetness
+        }
+
+
+def user_profile(catalog, ratings, positions):
+    """評価の二乗で重み付けしたユーザーの好み（特徴量の平均）を計算"""
+    weights = {}
+    total_weight = 0
+    for (wine_id, rating), position in zip(ratings, positions):
+        if position >= 0 and catalog.complete[position]:
+            weights[wine_id] = rating ** 2
+            total_weight += weights[wine_id]
+
+    if total_weight <= 0:
+        return None
+
+    profile = {}
+    for feature in FEATURES:
+        profile[feature] = sum(
+            getattr(catalog.rows[position], feature) * weights[wine_id]
+            for (wine_id, _), position in zip(ratings, positions)
+            if position >= 0 and catalog.complete[position]
+        ) / total_weight
+    return profile
+
+
+def variety_affinity(catalog, ratings, positions, sub_variety_weight=SUB_VARIETY_WEIGHT):
+    """
+    ユーザーが評価したワインの品種の分布（評価の二乗で重み付け、合計で正規化）
+    品種IDを添字とするベクトルで返す。末尾の要素は品種なし（-1）用で常に0
+    """
+    affinity = np.zeros(len(catalog.variety_ids) + 1, dtype=FEATURE_DTYPE)
+    weights = np.array([rating ** 2 for _, rating in ratings], dtype=FEATURE_DTYPE)
+    total_weight = weights.sum()
+    if total_weight <= 0:
+        return affinity
+
+    codes = catalog.variety_codes[positions]
+    has_variety = codes[:, 0] >= 0
+    # 評価順に加算（np.add.atは順序通りに加算される）
+    np.add.at(affinity, codes[has_variety, 0], weights[has_variety])
+    if sub_variety_weight:
+        for column in range(1, len(VARIETY_COLUMNS)):
+            has_variety = codes[:, column] >= 0
+            np.add.at(affinity, codes[has_variety, column], sub_variety_weight * weights[has_variety])
+    return affinity / total_weight
+
+
+def variety_similarity(catalog, affinity, members, sub_variety_weight=SUB_VARIETY_WEIGHT):
+    """品種IDでユーザーの品種分布を引き、候補ワインの品種の類似度を求める"""
+    codes = catalog.variety_codes[members]
+    similarity = affinity[codes[:, 0]]
+    if sub_variety_weight:
+        similarity = similarity + sub_variety_weight * (affinity[codes[:, 1]] + affinity[codes[:, 2]])
+        similarity = np.minimum(similarity, 1.0)
+    return similarity
+
+
+def feature_similarity(catalog, profile, members):
+    """候補ワインとユーザーの好みとの重み付きユークリッド距離を類似度（0-1）に変換"""
+    normalized = catalog.normalized[members]
+    weighted_diff_sum = np.zeros(len(members), dtype=FEATURE_DTYPE)
+    for column, feature in enumerate(FEATURES):
+        normalized_user = (profile[feature] - 1) / 4
+        weighted_diff_sum = weighted_diff_sum + \
+            FEATURE_WEIGHTS[feature] * (normalized_user - normalized[:, column]) ** 2
+    total_weight = sum(FEATURE_WEIGHTS.values())
+    return 1 - np.sqrt(weighted_diff_sum / total_weight)
+
+
+class UserTaste:
+    """1リクエスト分のユーザーの好み（特徴量の平均・品種分布・評価済みワイン）"""
+
+    def __init__(self, catalog, ratings, sub_variety_weight=SUB_VARIETY_WEIGHT, profile=None):
+        positions = catalog.positions([wine_id for wine_id, _ in ratings])
+        known = positions >= 0
+        ratings = [r for r, ok in zip(ratings, known) if ok]
+        positions = positions[known]
+
+        self.catalog = catalog
+        self.sub_variety_weight = sub_variety_weight
+        # 好みの平均はプロファイルテーブルの値を優先（なければ評価履歴から計算）
+        self.profile = profile if profile is not None else user_profile(catalog, ratings, positions)
+        # ユーザーの品種分布はリクエストごとに1回だけ計算
+        self.affinity = variety_affinity(catalog, ratings, positions, sub_variety_weight)
+        self.rated = np.zeros(len(catalog), dtype=bool)
+        self.rated[positions] = True
+        self.rated_positions = positions
+
+    def candidates(self, members):
+        """評価済みのワインを除外"""
+        return members[~self.rated[members]]
+
+    def max_variety_similarity(self):
+        """品種の類似度の上限（近傍探索の打ち切り判定に使用）"""
+        upper = self.affinity.max() if len(self.affinity) else 0.0
+        if self.sub_variety_weight:
+            upper = min(1.0, upper * (1 + 2 * self.sub_variety_weight))
+        return upper
+
+    def similarity(self, members):
+        # 特徴量と品種の類似度を9:1で線形結合
+        return FEATURE_SIMILARITY_RATIO * feature_similarity(self.catalog, self.profile, members) + \
+            VARIETY_SIMILARITY_RATIO * variety_similarity(self.catalog, self.affinity, members,
+                                                          self.sub_variety_weight)
+
+
+class TasteIndex:
+    """
+    ワインタイプごとの近傍探索インデックス（KD木またはBall木）
+    特徴量を重要度の平方根で拡大した空間では、ユークリッド距離が類似度計算の
+    重み付き距離と一致するため、好みに近いワインから順に取り出せる
+    """
+
+    def __init__(self, catalog, algorithm):
+        from sklearn.neighbors import NearestNeighbors
+
+        total_weight = sum(FEATURE_WEIGHTS.values())
+        self.scale = np.sqrt([FEATURE_WEIGHTS[feature] / total_weight for feature in FEATURES])
+        self.catalog = catalog
+        self.trees = {}
+        for wine_type, members in catalog.partitions.items():
+            if len(members):
+                self.trees[wine_type] = NearestNeighbors(algorithm=algorithm).fit(
+                    catalog.normalized[members] * self.scale
+                )
+
+    def candidates(self, taste, wine_type, limit):
+        """
+        パーティション内で上位limit件に入り得る未評価ワインの行番号（ID順）
+        近い順に取得し、未取得のワインが上位に入り得なくなるまで取得件数を倍にする
+        """
+        members = self.catalog.partitions[wine_type]
+        tree = self.trees.get(wine_type)
+        if tree is None:
+            return members[:0]
+
+        point = np.array([[(taste.profile[feature] - 1) / 4 for feature in FEATURES]]) * self.scale
+        rated = int(np.count_nonzero(self.catalog.partition_of[taste.rated_positions] == wine_type))
+        max_variety = taste.max_variety_similarity()
+        k = min(len(members), limit + rated)
+        while True:
+            distances, neighbors = tree.kneighbors(point, n_neighbors=k)
+            positions = taste.candidates(members[neighbors[0]])
+            if k == len(members):
+                break
+            similarity = taste.similarity(positions)
+            if len(similarity) >= limit:
+                # 未取得のワインの類似度の上限（距離は取得済みの最大値以上）
+                bound = FEATURE_SIMILARITY_RATIO * (1 - distances[0, -1] + 1e-9) + \
+                    VARIETY_SIMILARITY_RATIO * max_variety
+                if np.partition(similarity, len(similarity) - limit)[len(similarity) - limit] > bound:
+                    break
+            k = min(len(members), k * 2)
+        return np.sort(positions)
+
+
+def recommend(catalog, ratings, types=RECOMMENDATION_TYPES, limit=RECOMMENDATION_LIMIT,
+              sub_variety_weight=SUB_VARIETY_WEIGHT, profile=None, algorithm='brute'):
+    """ワインタイプごとに類似度の高い順に上位limit件を返す"""
+    recommendations = empty_recommendations(types)
+    taste = UserTaste(catalog, ratings, sub_variety_weight, profile)
+    if taste.profile is None:
+        return recommendations
+
+    index = catalog.index(algorithm) if algorithm != 'brute' else None
+    for section in types:
+        partitions = section_partitions(section, types)
+        if index is None:
+            members = taste.candidates(catalog.members(partitions))
+        else:
+            members = np.sort(np.concatenate([index.candidates(taste, p, limit) for p in partitions]))
+        similarity = taste.similarity(members)
+        recommendations[section] = [catalog.to_dict(members[i], similarity[i]) for i in top_k(similarity, limit)]
+    return recommendations
+
+
+class RecommendationEngine:
+    """
+    カタログのスナップショットを保持するレコメンデーションエンジン
+    ワインテーブルが変更されると次回のリクエスト時にカタログ（タイプ別パーティションを含む）を
+    再読み込みします。
+    """
+
+    def __init__(self):
+        self._catalog = None
+        self._stale = True
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._versions = itertools.count(1)
+
+    def invalidate(self, changes=None):
+        self._stale = True
+
+    def catalog(self, session):
+        # このプロセスでの変更がなければ、他のプロセスの変更はCATALOG_CHECK_INTERVALごとに確認
+        # （件数・最大IDの集計を毎リクエスト実行しない）
+        catalog = self._catalog
+        now = time.monotonic()
+        if catalog is not None and not self._stale and now - self._checked_at < CATALOG_CHECK_INTERVAL:
+            return catalog
+        self._checked_at = now
+        fingerprint = wine_fingerprint(session)
+        if catalog is None or self._stale or catalog.fingerprint != fingerprint:
+            with self._lock:
+                catalog = self._catalog
+                if catalog is None or self._stale or catalog.fingerprint != fingerprint:
+                    self._stale = False
+                    catalog = WineCatalog.load(session, fingerprint, next(self._versions))
+                    self._catalog = catalog
+        return catalog
+
+    def recommend(self, session, ratings, types=RECOMMENDATION_TYPES, limit=RECOMMENDATION_LIMIT,
+                  sub_variety_weight=SUB_VARIETY_WEIGHT, profile=None, algorithm='brute'):
+        if not ratings:
+            return empty_recommendations(types)
+        return recommend(self.catalog(session), ratings, types, limit, sub_variety_weight, profile, algorithm)
+
+
+recommendation_engine = RecommendationEngine()
+on_wine_change(recommendation_engine.invalidate)
@@ -0,0 +1,392 @@
+"""
+ワイン名・品種のn-gram転置インデックス
+ILIKE '%q%'による全件スキャンの代わりに、クエリのn-gramを含むワインを
+ポスティングリストの積集合で絞り込んでから部分一致を確認します。
+ワイン名と品種（3列）は1回の検索でまとめて照合し、関連度順に並べます。
+ラテン文字・日本語（カタカナ・漢字）とも文字単位のn-gramとして扱います。
+照合にはWineに保存した正規化済みの検索キー（search_keys.py）を使用します。
+"""
+import heapq
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import defaultdict
+from models import Wine
+from catalog_events import on_wine_change, wine_fingerprint
+from recommender import normalize_wine_type
+from search_keys import normalize_search_text, variety_search_key, split_variety_search_key
+
+# インデックスするn-gramの長さ（2文字のクエリ用にbigramも保持）
+GRAM_SIZE = 3
+MIN_QUERY_LENGTH = 2
+
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+# 補完候補の順位付けのために走査する最大件数
+MAX_PREFIX_SCAN = 200
+
+# 他のプロセスによる変更を確認する間隔（秒）
+SYNC_INTERVAL = 1.0
+
+# 単語の区切り（単語の先頭からの前方一致にも対応する）
+WORD_SEPARATOR = re.compile(r'[\s・･/,()（）]+')
+
+VARIETY_FIELDS = ('variety', 'variety_sub1', 'variety_sub2')
+# 検索対象のフィールド（この順序が同じ一致の種類での優先順位）
+SEARCH_FIELDS = ('name',) + VARIETY_FIELDS
+
+# 一致の種類（小さいほど上位）
+MATCH_EXACT = 0
+MATCH_PREFIX = 1
+MATCH_SUBSTRING = 2
+
+
+def ngrams(text, size):
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def query_grams(query):
+    """クエリのn-gram（GRAM_SIZEより短いクエリはbigram）"""
+    return ngrams(query, GRAM_SIZE if len(query) >= GRAM_SIZE else MIN_QUERY_LENGTH)
+
+
+class FieldIndex:
+    """
+    複数フィールド（ワイン名・品種）に対するn-gram転置インデックス
+    テキストはフィールドの順序を保ったタプルで保持し、一致したフィールドを順位付けに使います。
+    """
+
+    def __init__(self):
+        self.texts = {}                  # wine_id -> 正規化済みテキストのタプル（フィールド順、空文字あり）
+        self.postings = defaultdict(set)  # n-gram -> wine_idの集合
+
+    @staticmethod
+    def _grams(texts):
+        grams = set()
+        for text in texts:
+            grams |= ngrams(text, GRAM_SIZE)
+            grams |= ngrams(text, MIN_QUERY_LENGTH)
+        return grams
+
+    def add(self, wine_id, texts):
+        self.remove(wine_id)
+        texts = tuple(text or '' for text in texts)
+        if not any(texts):
+            return
+        self.texts[wine_id] = texts
+        for gram in self._grams(texts):
+            self.postings[gram].add(wine_id)
+
+    def remove(self, wine_id):
+        texts = self.texts.pop(wine_id, None)
+        if not texts:
+            return
+        for gram in self._grams(texts):
+            posting = self.postings.get(gram)
+            if posting is not None:
+                posting.discard(wine_id)
+                if not posting:
+                    del self.postings[gram]
+
+    @staticmethod
+    def _rank(query, texts):
+        """
+        最も良く一致したフィールドの順位（小さいほど上位、一致しなければNone）
+        完全一致 > 前方一致 > 部分一致の順で、同じ一致の種類ではフィールドの順序で比較
+        """
+        best = None
+        for field, text in enumerate(texts):
+            position = text.find(query)
+            if position < 0:
+                continue
+            if position > 0:
+                match = MATCH_SUBSTRING
+            elif len(text) == len(query):
+                match = MATCH_EXACT
+            else:
+                match = MATCH_PREFIX
+            rank = match * len(texts) + field
+            if best is None or rank < best:
+                best = rank
+        return best
+
+    def search(self, query, limit, include=None):
+        """
+        部分一致するワインIDを関連度順（同順位はID順）に最大limit件返す
+        includeを指定した場合はinclude(wine_id)が真のワインのみ
+        """
+        postings = [self.postings.get(gram) for gram in query_grams(query)]
+        if not postings or any(posting is None for posting in postings):
+            return []
+        # 小さいポスティングリストから積集合を取る
+        postings.sort(key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        ranked = []
+        for wine_id in candidates:
+            if include is not None and not include(wine_id):
+                continue
+            # n-gramをすべて含んでいても連続しているとは限らないため部分一致を確認
+            rank = self._rank(query, self.texts[wine_id])
+            if rank is not None:
+                ranked.append((rank, wine_id))
+        return [wine_id for _, wine_id in heapq.nsmallest(limit, ranked)]
+
+
+def word_suffixes(text):
+    """テキスト全体と、各単語の先頭から始まる部分文字列"""
+    suffixes = [text]
+    for match in WORD_SEPARATOR.finditer(text):
+        if match.end() < len(text):
+            suffixes.append(text[match.end():])
+    return suffixes
+
+
+class PrefixIndex:
+    """
+    ワイン名と品種の前方一致検索用のソート済み配列
+    キーはワイン名全体と各単語から始まる部分文字列で、bisectで範囲を特定します。
+    名前全体のキーと単語のキーは別の配列に分け、走査の上限（MAX_PREFIX_SCAN）に
+    多数の単語の一致が入っても順位の高い名前全体の一致が漏れないようにします。
+    """
+
+    def __init__(self):
+        self.name_entries = []      # (名前全体のキー, wine_id)のソート済みリスト
+        self.word_entries = []      # (2番目以降の単語から始まるキー, wine_id)のソート済みリスト
+        self.names = {}             # wine_id -> (表示名, キーのリスト)
+        self.variety_keys = []      # 品種のキーのソート済みリスト
+        self.varieties = {}         # 品種のキー -> [表示名, ワイン数]
+        self.wine_varieties = {}    # wine_id -> 品種のキーのタプル
+
+    def add(self, wine_id, name, key, varieties, sort=True):
+        """varietiesは(検索キー, 表示名)のリスト"""
+        self.remove(wine_id)
+        if key:
+            keys = word_suffixes(key)
+            self.names[wine_id] = (name, keys)
+            for entries, suffix in self._entries(keys):
+                if sort:
+                    insort(entries, (suffix, wine_id))
+                else:
+                    entries.append((suffix, wine_id))
+
+        variety_keys = tuple({key: variety for key, variety in varieties if key}.items())
+        self.wine_varieties[wine_id] = tuple(key for key, _ in variety_keys)
+        for key, variety in variety_keys:
+            entry = self.varieties.get(key)
+            if entry is None:
+                self.varieties[key] = [variety, 1]
+                if sort:
+                    insort(self.variety_keys, key)
+                else:
+                    self.variety_keys.append(key)
+            else:
+                entry[1] += 1
+
+    def sort(self):
+        """sort=Falseで追加した後にまとめて並べ替える"""
+        self.name_entries.sort()
+        self.word_entries.sort()
+        self.variety_keys.sort()
+
+    def _entries(self, keys):
+        """word_suffixes()のキーと追加先の配列の組（先頭は名前全体のキー）"""
+        yield self.name_entries, keys[0]
+        for suffix in keys[1:]:
+            yield self.word_entries, suffix
+
+    def remove(self, wine_id):
+        name = self.names.pop(wine_id, None)
+        if name is not None:
+            for entries, suffix in self._entries(name[1]):
+                position = bisect_left(entries, (suffix, wine_id))
+                if position < len(entries) and entries[position] == (suffix, wine_id):
+                    del entries[position]
+        for key in self.wine_varieties.pop(wine_id, ()):
+            entry = self.varieties[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.varieties[key]
+                del self.variety_keys[bisect_left(self.variety_keys, key)]
+
+    def _scan(self, keys, prefix):
+        """prefixで始まるキーを先頭から最大MAX_PREFIX_SCAN件返す"""
+        position = bisect_left(keys, prefix)
+        end = min(len(keys), position + MAX_PREFIX_SCAN)
+        while position < end:
+            key = keys[position]
+            if not key.startswith(prefix):
+                break
+            yield key
+            position += 1
+
+    def complete(self, prefix, limit):
+        """
+        前方一致する補完候補を順位順に返す
+        完全一致 > 名前の先頭からの一致 > 単語の先頭からの一致の順で、同順位は短い方を優先
+        """
+        ranked = {}
+        # 名前全体の一致と単語の一致をそれぞれ最大MAX_PREFIX_SCAN件ずつ走査する
+        for entries in (self.name_entries, self.word_entries):
+            position = bisect_left(entries, (prefix,))
+            end = min(len(entries), position + MAX_PREFIX_SCAN)
+            while position < end:
+                key, wine_id = entries[position]
+                if not key.startswith(prefix):
+                    break
+                name, keys = self.names[wine_id]
+                rank = (key != prefix, entries is self.word_entries, len(name), 0, wine_id)
+                # 同じワインが複数の単語で一致した場合は最も高い順位を採用
+                current = ranked.get(('name', wine_id))
+                if current is None or rank < current[0]:
+                    ranked[('name', wine_id)] = (rank, {'type': 'name', 'id': wine_id, 'text': name})
+                position += 1
+
+        for key in self._scan(self.variety_keys, prefix):
+            variety, count = self.varieties[key]
+            rank = (key != prefix, False, len(variety), 1, -count)
+            ranked[('variety', key)] = (rank, {'type': 'variety', 'text': variety, 'count': count})
+
+        return [completion for _, completion in heapq.nsmallest(limit, ranked.values(), key=lambda item: item[0])]
+
+
+class WineSearchIndex:
+    """
+    ワイン名と品種の検索インデックス
+    ワインの追加・更新・削除はコミット後に差分だけ反映し、
+    他のプロセスによる変更（件数・最大ID・カタログのバージョンの変化）を検出した場合は作り直します。
+    """
+
+    def __init__(self):
+        self.fields = FieldIndex()
+        self.prefixes = PrefixIndex()
+        self.types = {}  # wine_id -> ワインタイプ（red/white/sparkling/rose/other）
+        self.ids = set()
+        self._fingerprint = None
+        self._checked_at = 0.0
+        self._stale = True
+        self._pending = set()
+        self._changed = False  # このプロセスで変更を反映済み（件数・最大IDの変化が想定内）
+        self._commits = 0  # 前回の同期以降に反映したこのプロセスのコミット数（カタログのバージョンの加算分）
+        self._lock = threading.Lock()
+
+    def on_change(self, changes):
+        with self._lock:
+            if changes.full:
+                self._stale = True
+                return
+            for wine_id in changes.deleted:
+                self._remove(wine_id)
+            self._pending |= changes.upserted - changes.deleted
+            self._changed = True
+            self._commits += 1
+
+    def _add(self, row, sort=True):
+        # 検索キーが未設定（バックフィル前）の場合はその場で正規化
+        name_key = row.search_key if row.search_key is not None else normalize_search_text(row.name)
+        variety_keys = split_variety_search_key(
+            row.variety_search_key if row.variety_search_key is not None
+            else variety_search_key(*[getattr(row, field) for field in VARIETY_FIELDS])
+        )
+        varieties = list(zip(variety_keys, [getattr(row, field) for field in VARIETY_FIELDS]))
+
+        self.ids.add(row.id)
+        self.types[row.id] = normalize_wine_type(row.wine_type)
+        self.fields.add(row.id, [name_key] + variety_keys)
+        self.prefixes.add(row.id, row.name, name_key, varieties, sort)
+
+    def _remove(self, wine_id):
+        self.ids.discard(wine_id)
+        self.types.pop(wine_id, None)
+        self.fields.remove(wine_id)
+        self.prefixes.remove(wine_id)
+
+    def _query(self, session):
+        columns = [Wine.id, Wine.name] + [getattr(Wine, field) for field in VARIETY_FIELDS] + \
+            [Wine.wine_type, Wine.search_key, Wine.variety_search_key]
+        return session.query(*columns).filter(Wine.retired_at.is_(None))
+
+    def _rebuild(self, session):
+        self.fields = FieldIndex()
+        self.prefixes = PrefixIndex()
+        self.types = {}
+        self.ids = set()
+        for row in self._query(session).yield_per(1000):
+            self._add(row, sort=False)
+        self.prefixes.sort()
+
+    def _apply_pending(self, session):
+        pending, self._pending = self._pending, set()
+        if not pending:
+            return
+        rows = {row.id: row for row in self._query(session).filter(Wine.id.in_(pending))}
+        for wine_id in pending:
+            if wine_id in rows:
+                self._add(rows[wine_id])
+            else:
+                self._remove(wine_id)
+
+    def _sync(self, session):
+        """インデックスをワインテーブルと同期（ロックを取得した状態で呼び出す）"""
+        # このプロセスでの変更がなければ、他のプロセスの変更はSYNC_INTERVALごとに確認
+        now = time.monotonic()
+        if not self._stale and not self._changed and now - self._checked_at < SYNC_INTERVAL:
+            return
+        self._checked_at = now
+        fingerprint = wine_fingerprint(session)
+        if not self._stale and self._changed:
+            self._apply_pending(session)
+            # このプロセスのコミット以外でバージョンが進んでいれば、他のプロセスが変更している
+            version = self._fingerprint[2]
+            expected = (len(self.ids), max(self.ids, default=None),
+                        version + self._commits if version is not None else None)
+            if expected != fingerprint:
+                self._stale = True
+        elif fingerprint != self._fingerprint:
+            self._stale = True
+        if self._stale:
+            self._stale = False
+            self._pending = set()
+            self._rebuild(session)
+        self._changed = False
+        self._commits = 0
+        self._fingerprint = fingerprint
+
+    def sync(self, session):
+        with self._lock:
+            self._sync(session)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, session, query, limit=SEARCH_LIMIT, wine_type=None):
+        """
+        ワイン名・品種を1回で部分一致検索し、一致したワインIDを関連度順に最大limit件返す
+        wine_typeを指定した場合はそのタイプ（normalize_wine_typeで正規化した値）のワインのみ
+        """
+        query = normalize_search_text(query)
+        with self._lock:
+            self._sync(session)
+            if len(query) < MIN_QUERY_LENGTH:
+                return []
+            include = None
+            if wine_type is not None:
+                types = self.types
+                include = lambda wine_id: types.get(wine_id) == wine_type
+            return self.fields.search(query, limit, include)
+
+    def complete(self, session, prefix, limit=AUTOCOMPLETE_LIMIT):
+        """ワイン名・品種の前方一致による補完候補"""
+        prefix = normalize_search_text(prefix)
+        with self._lock:
+            self._sync(session)
+            if not prefix:
+                return []
+            return self.prefixes.complete(prefix, limit)
+
+
+wine_search_index = WineSearchIndex()
+on_wine_change(wine_search_index.on_change)
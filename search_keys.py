@@ -0,0 +1,95 @@
+"""
+検索用の正規化キー
+NFKC正規化（全角・半角の統一）、大文字小文字の統一、アクセント記号の除去、
+ひらがな・カタカナの統一を行った文字列をWineに保存し、検索時はこのキーと照合します。
+"""
+import unicodedata
+from sqlalchemy import event, update
+from models import Wine
+
+# 品種の検索キーの区切り文字（variety, variety_sub1, variety_sub2の順）
+VARIETY_KEY_SEPARATOR = '|'
+
+# 除去しない結合文字（日本語の濁点・半濁点）
+KANA_VOICING_MARKS = {'゙', '゚'}
+
+
+def _hiragana_to_katakana(char):
+    code = ord(char)
+    if 0x3041 <= code <= 0x3096 or 0x309d <= code <= 0x309e:
+        return chr(code + 0x60)
+    return char
+
+
+def normalize_search_text(text):
+    """
+    検索用にテキストを正規化
+    例: 'Château' -> 'chateau', 'ｼｬﾄｰ' / 'しゃとー' -> 'シャトー'
+    """
+    if not text:
+        return ''
+    # 全角英数字・半角カタカナなどを統一し、大文字小文字を区別しない形に変換
+    text = unicodedata.normalize('NFKC', text).casefold()
+    # アクセント記号を除去（濁点・半濁点は残す）
+    text = ''.join(
+        char for char in unicodedata.normalize('NFD', text)
+        if char in KANA_VOICING_MARKS or not unicodedata.combining(char)
+    )
+    text = unicodedata.normalize('NFC', text)
+    # ひらがなをカタカナに統一
+    return ''.join(_hiragana_to_katakana(char) for char in text)
+
+
+def variety_search_key(variety, variety_sub1, variety_sub2):
+    return VARIETY_KEY_SEPARATOR.join(
+        normalize_search_text(v).replace(VARIETY_KEY_SEPARATOR, ' ') for v in (variety, variety_sub1, variety_sub2)
+    )
+
+
+def split_variety_search_key(key):
+    return key.split(VARIETY_KEY_SEPARATOR)
+
+
+def wine_search_keys(name, variety, variety_sub1, variety_sub2):
+    """Wineに保存する検索キー（search_key, variety_search_key）"""
+    return {
+        'search_key': normalize_search_text(name),
+        'variety_search_key': variety_search_key(variety, variety_sub1, variety_sub2)
+    }
+
+
+def _set_search_keys(mapper, connection, target):
+    # ORM経由で追加・更新されるワインは保存時に検索キーを設定
+    for column, value in wine_search_keys(target.name, target.variety, target.variety_sub1,
+                                          target.variety_sub2).items():
+        setattr(target, column, value)
+
+
+event.listen(Wine, 'before_insert', _set_search_keys)
+event.listen(Wine, 'before_update', _set_search_keys)
+
+
+def backfill_search_keys(session, all_rows=False, batch_size=1000):
+    """
+    検索キーが未設定のワイン（all_rows=Trueの場合は全ワイン）の検索キーを設定
+    主キーの範囲ごとにまとめて更新し、更新した件数を返す
+    """
+    last_id = 0
+    count = 0
+    while True:
+        query = session.query(Wine.id, Wine.name, Wine.variety, Wine.variety_sub1, Wine.variety_sub2).filter(
+            Wine.id > last_id
+        )
+        if not all_rows:
+            query = query.filter(Wine.search_key.is_(None))
+        rows = query.order_by(Wine.id).limit(batch_size).all()
+        if not rows:
+            break
+        session.execute(update(Wine), [
+            {'id': row.id, **wine_search_keys(row.name, row.variety, row.variety_sub1, row.variety_sub2)}
+            for row in rows
+        ])
+        session.commit()
+        last_id = rows[-1].id
+        count += len(rows)
+    return count
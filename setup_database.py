@@ -3,12 +3,165 @@ Direct database setup script for Render deployment.
 This script explicitly creates tables and sample data.
 """
 from app import app, db, Wine, UserPreference
+from catalog_loader import CHUNK_SIZE, LoadProgress, load_wines, parse_chunks, sync_wines
+from contextlib import nullcontext
 from datetime import datetime
+from flask import has_app_context
+import argparse
+import itertools
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_numeric_dtype
 import os
 
-def load_from_csv():
-    """Load wine data from the wine_info.csv file"""
+# 韓国語（ハングル音節）の範囲（U+AC00-U+D7A3、元の判定 0xAC00 < c < 0xD7A4 と同じくU+AC00は含まない）
+HANGUL_PATTERN = '[\uac01-\ud7a3]'
+
+# Wineの列 -> (CSVの列, レベルの接頭辞, デフォルト値)
+TASTE_LEVEL_COLUMNS = {
+    'acidity': ('acidity', 'ACIDITY', 3.0),
+    'tannin': ('tannin', 'TANNIN', 3.0),
+    'body': ('body', 'BODY', 3.0),
+    'sweetness': ('sweet', 'SWEET', 1.0),  # CSVファイルでは 'sweet' という列名で甘さが保存されている
+}
+
+# CSVの種類（type列）の分類と読み込む順序（どれにも一致しないワインは'other'）
+WINE_TYPE_PATTERNS = {
+    'red': 'red',
+    'white': 'white',
+    'sparkling': 'sparkling',
+    'rose': 'rose|rosé',
+}
+WINE_TYPE_GROUPS = tuple(WINE_TYPE_PATTERNS) + ('other',)
+
+# 品種の列 -> (CSVの列, 列がない・値が空の場合に使う列の位置)
+VARIETY_COLUMNS = {
+    'variety': ('variety', 8),
+    'variety_sub1': ('variety_sub1', 9),
+    'variety_sub2': ('variety_sub2', 10),
+}
+
+
+def _strings(values):
+    """空でない値を文字列にしたSeries（空の値はNaNのまま）"""
+    return values.astype(object).where(values.isna(), values.astype(str))
+
+
+def _lowercase(values):
+    """文字列の値を小文字にしたSeries（文字列でない値はNaN。チャンク内がすべて空の列は数値型になる）"""
+    if is_numeric_dtype(values):
+        return pd.Series(np.nan, index=values.index, dtype=object)
+    return values.str.lower()
+
+
+def _variety_column(df, column, position):
+    """品種の列（列名がない、または値が空の場合はposition番目の列）。どちらも空なら''"""
+    result = pd.Series('', index=df.index, dtype=object)
+    if len(df.columns) > position:
+        fallback = _strings(df.iloc[:, position])
+        result = fallback.where(fallback.notna(), result)
+    if column in df.columns:
+        values = _strings(df[column])
+        result = values.where(values.notna(), result)
+    return result
+
+
+def _level_column(df, column, prefix, default):
+    """ACIDITY1～ACIDITY5などのレベルを1.0～5.0に変換（複数含む場合は小さいレベル、該当なしはdefault）"""
+    if column not in df.columns:
+        return pd.Series(default, index=df.index, dtype=float)
+    values = _strings(df[column]).fillna('')
+    conditions = [values.str.contains(f'{prefix}{level}', regex=False) for level in range(1, 6)]
+    return pd.Series(np.select(conditions, [1.0, 2.0, 3.0, 4.0, 5.0], default), index=df.index)
+
+
+def _numbers(values):
+    """数値の列をfloatに変換（文字列の値はNaN。元の処理では文字列の値は計算できず0になる）"""
+    if not is_numeric_dtype(values):
+        values = pd.to_numeric(values.where(~values.map(lambda value: isinstance(value, str))), errors='coerce')
+    return values.astype(float)
+
+
+def _truncate(values):
+    """整数に切り捨て（空・無限大は0）"""
+    return np.trunc(values.where(np.isfinite(values), 0)).astype(np.int64)
+
+
+def _vintage_column(df):
+    if 'vintage' not in df.columns:
+        return pd.Series(0, index=df.index, dtype=np.int64)
+    values = df['vintage']
+    if not is_numeric_dtype(values):
+        def to_int(value):
+            try:
+                return int(value)
+            except (TypeError, ValueError, OverflowError):
+                return 0
+        return values.map(lambda value: 0 if pd.isna(value) else to_int(value)).astype(np.int64)
+    return _truncate(_numbers(values))
+
+
+def wine_type_groups(types):
+    """
+    各行が読み込まれる種類（最初に一致した分類）
+    複数の分類に一致するワイン（red sparklingなど）は先の分類で追加され、後の分類では名前の重複として除外される
+    """
+    lowered = _lowercase(types)
+    groups = pd.Series('other', index=types.index, dtype=object)
+    for group in reversed(tuple(WINE_TYPE_PATTERNS)):
+        groups = groups.where(~lowered.str.contains(WINE_TYPE_PATTERNS[group], na=False, regex=True), group)
+    return groups
+
+
+def decode_wine_columns(df):
+    """
+    CSVのDataFrameをWineの列に変換する（行ごとではなく列ごとにまとめて変換）
+    名前が空・韓国語を含む行とワインタイプが文字列でない行は除外し、元の行の順序で返す
+    """
+    # ワイン名から韓国語パートを除去（カンマで区切られている場合は2番目の部分を使用）
+    if 'name' in df.columns:
+        raw_names = _strings(df['name']).fillna('')
+        parts = raw_names.str.split(',')
+        names = parts.str.get(1).fillna('').str.strip().where(parts.str.len() > 1, raw_names)
+    else:
+        names = pd.Series('', index=df.index, dtype=object)
+
+    wines = pd.DataFrame({'name': names}, index=df.index)
+    for field, (column, position) in VARIETY_COLUMNS.items():
+        # 品種名から韓国語を除去
+        wines[field] = _variety_column(df, column, position).str.replace(HANGUL_PATTERN, '', regex=True)
+    wines['vintage'] = _vintage_column(df)
+
+    keep = (names.str.strip() != '') & ~names.str.contains(HANGUL_PATTERN, regex=True)
+    if 'type' in df.columns:
+        types = _lowercase(df['type'])
+        # 文字列でないワインタイプの行は除外
+        keep &= types.isna() == df['type'].isna()
+        wines['wine_type'] = types.where(types.notna(), 'red')
+    else:
+        wines['wine_type'] = 'red'
+
+    # 価格は1/10にして切り捨て
+    wines['price'] = _truncate(_numbers(df['price']) / 10) if 'price' in df.columns else 0
+
+    for field, (column, prefix, default) in TASTE_LEVEL_COLUMNS.items():
+        wines[field] = _level_column(df, column, prefix, default)
+    return wines[keep.to_numpy()]
+
+def decode_wine_records(df):
+    """decode_wine_columnsの結果をWineの列の辞書のリストにする（プロセスプールのワーカーで実行される）"""
+    return decode_wine_columns(df).to_dict('records')
+
+def app_context():
+    """実行中のアプリケーションのコンテキスト（アプリケーションの外から呼ばれた場合はapp.pyのアプリケーション）"""
+    return nullcontext() if has_app_context() else app.app_context()
+
+def load_from_csv(sync=False, workers=1):
+    """
+    Load wine data from the wine_info.csv file
+    sync=Trueの場合は既存のワインとの差分のみを反映する（catalog_loader.sync_wines）
+    workers > 1の場合は列の変換をworkers個のプロセスで行う（種類の分類・重複の除外と書き込みはこのプロセス）
+    """
     # プロジェクトディレクトリ内のCSVファイルを使用
     csv_path = os.path.join(os.path.dirname(__file__), 'wine_info.csv')
     
@@ -19,208 +172,51 @@ def load_from_csv():
         
     try:
         print(f"Loading wine data from {csv_path}...")
-        # Read the CSV file
-        df = pd.read_csv(csv_path, encoding='utf-8')
-        
-        # 様々な種類のワインをロードするように改善
-        # まず、ワインの種類ごとに分ける
-        red_wines = df[df['type'].str.lower().str.contains('red', na=False)]
-        white_wines = df[df['type'].str.lower().str.contains('white', na=False)]
-        sparkling_wines = df[df['type'].str.lower().str.contains('sparkling', na=False)]
-        rose_wines = df[df['type'].str.lower().str.contains('rose|rosé', na=False, regex=True)]
-        other_wines = df[~df.index.isin(red_wines.index) & 
-                          ~df.index.isin(white_wines.index) & 
-                          ~df.index.isin(sparkling_wines.index) & 
-                          ~df.index.isin(rose_wines.index)]
-        
-        print(f"Found in CSV: {len(red_wines)} red, {len(white_wines)} white, "
-              f"{len(sparkling_wines)} sparkling, {len(rose_wines)} rose, "
-              f"{len(other_wines)} other wines")
-        
-        # 各種類からワインを選択
-        selected_red = red_wines
-        selected_white = white_wines
-        selected_sparkling = sparkling_wines
-        selected_rose = rose_wines
-        selected_other = other_wines
-        
-        # 選択したワインを結合
-        df_combined = pd.concat([selected_red, selected_white, selected_sparkling, selected_rose, selected_other])
-        
-        # 重複を除去
-        df = df_combined.drop_duplicates(subset=['name'])
-        
-        print(f"Loaded {len(df)} wines from CSV file")
-        
-        # Convert dataframe rows to Wine objects
-        for _, row in df.iterrows():
-            try:
-                # Extract wine name and clean up Korean text
-                name = ''
-                if 'name' in row and pd.notna(row['name']):
-                    # ワイン名から韓国語パートを除去（通常は最初の部分）
-                    raw_name = str(row['name'])
-                    # 韓国語とそれ以外のパートを分離
-                    parts = raw_name.split(',')
-                    if len(parts) > 1:
-                        # カンマで区切られている場合は2番目の部分を使用
-                        name = parts[1].strip()
-                    else:
-                        name = raw_name
-                    
-                # 品種情報のクリーンアップと抽出
-                variety = ''
-                variety_sub1 = ''
-                variety_sub2 = ''
-                
-                # カラムの位置ではなく名前で品種を特定
-                if 'variety' in row.index and pd.notna(row['variety']):
-                    variety = str(row['variety'])
-                elif len(row) > 8 and pd.notna(row[8]):
-                    variety = str(row[8])
-                    
-                if 'variety_sub1' in row.index and pd.notna(row['variety_sub1']):
-                    variety_sub1 = str(row['variety_sub1'])
-                elif len(row) > 9 and pd.notna(row[9]):
-                    variety_sub1 = str(row[9])
-                    
-                if 'variety_sub2' in row.index and pd.notna(row['variety_sub2']):
-                    variety_sub2 = str(row['variety_sub2'])
-                elif len(row) > 10 and pd.notna(row[10]):
-                    variety_sub2 = str(row[10])
-                
-                # Extract vintage as integer
-                vintage = 0
-                if 'vintage' in row and pd.notna(row['vintage']):
-                    try:
-                        vintage = int(row['vintage'])
-                    except:
-                        vintage = 0
-                
-                # Extract wine type
-                wine_type = 'red'  # Default
-                if 'type' in row and pd.notna(row['type']):
-                    wine_type = row['type'].lower()
-                
-                # Extract price
-                price = 0
-                if 'price' in row and pd.notna(row['price']):
-                    try:
-                        price = int(row['price']/10)
-                    except:
-                        price = 0
-                
-                # Handle taste attributes
-                acidity = 3.0  # Default values
-                tannin = 3.0
-                body = 3.0
-                sweetness = 1.0
-                
-                # CSVファイルでは 'sweet' という列名で甘さが保存されている
-                if 'sweet' in row.index and pd.notna(row['sweet']):
-                    sweetness_str = str(row['sweet'])
-                    if 'SWEET1' in sweetness_str:
-                        sweetness = 1.0
-                    elif 'SWEET2' in sweetness_str:
-                        sweetness = 2.0
-                    elif 'SWEET3' in sweetness_str:
-                        sweetness = 3.0
-                    elif 'SWEET4' in sweetness_str:
-                        sweetness = 4.0
-                    elif 'SWEET5' in sweetness_str:
-                        sweetness = 5.0
-                    # print(f"Processed sweetness value: {sweetness_str} -> {sweetness}")
-                
-                # 'acidity' 列からデータを取得
-                if 'acidity' in row.index and pd.notna(row['acidity']):
-                    acidity_str = str(row['acidity'])
-                    if 'ACIDITY1' in acidity_str:
-                        acidity = 1.0
-                    elif 'ACIDITY2' in acidity_str:
-                        acidity = 2.0
-                    elif 'ACIDITY3' in acidity_str:
-                        acidity = 3.0
-                    elif 'ACIDITY4' in acidity_str:
-                        acidity = 4.0
-                    elif 'ACIDITY5' in acidity_str:
-                        acidity = 5.0
-                
-                # 'body' 列からデータを取得
-                if 'body' in row.index and pd.notna(row['body']):
-                    body_str = str(row['body'])
-                    if 'BODY1' in body_str:
-                        body = 1.0
-                    elif 'BODY2' in body_str:
-                        body = 2.0
-                    elif 'BODY3' in body_str:
-                        body = 3.0
-                    elif 'BODY4' in body_str:
-                        body = 4.0
-                    elif 'BODY5' in body_str:
-                        body = 5.0
-                
-                # 'tannin' 列からデータを取得
-                if 'tannin' in row.index and pd.notna(row['tannin']):
-                    tannin_str = str(row['tannin'])
-                    if 'TANNIN1' in tannin_str:
-                        tannin = 1.0
-                    elif 'TANNIN2' in tannin_str:
-                        tannin = 2.0
-                    elif 'TANNIN3' in tannin_str:
-                        tannin = 3.0
-                    elif 'TANNIN4' in tannin_str:
-                        tannin = 4.0
-                    elif 'TANNIN5' in tannin_str:
-                        tannin = 5.0
-                
-                # 韓国語を含む行は除外するチェック
-                if name.strip() == '' or any(ord(c) > 0xAC00 and ord(c) < 0xD7A4 for c in name):
-                    # 空の名前または韓国語文字を含む場合はスキップ
-                    continue
-                    
-                # 品種名もクリーンアップ
-                def clean_text(text):
-                    # 韓国語の範囲はU+AC00-U+D7A3
-                    return ''.join([c for c in text if not (ord(c) > 0xAC00 and ord(c) < 0xD7A4)])
-                
-                variety = clean_text(variety)
-                variety_sub1 = clean_text(variety_sub1)
-                variety_sub2 = clean_text(variety_sub2)
-                
-                # Create Wine object
-                wine = Wine(
-                    name=name,
-                    variety=variety,
-                    variety_sub1=variety_sub1,
-                    variety_sub2=variety_sub2,
-                    vintage=vintage,
-                    wine_type=wine_type,
-                    price=price,
-                    acidity=acidity,
-                    tannin=tannin,
-                    body=body,
-                    sweetness=sweetness
-                )
-                
-                # Add to session
-                db.session.add(wine)
-                
-            except Exception as e:
-                print(f"Error processing wine row: {e}")
-                continue
+        # 種類ごとにCSVをチャンク単位で読み込み（赤・白・スパークリング・ロゼ・その他の順）、
+        # 名前が重複するワインは最初のもののみを追加する
+        seen_names = set()
+
+        def chunks(group):
+            found = 0
+            for chunk in pd.read_csv(csv_path, encoding='utf-8', chunksize=CHUNK_SIZE):
+                selected = chunk[wine_type_groups(chunk['type']) == group]
+                found += len(selected)
+                names = selected['name']
+                # 読み込み済みの名前はsetで判定（isinは呼び出しごとにsetを配列に変換するため使わない）
+                unseen = np.fromiter((name not in seen_names for name in names), dtype=bool, count=len(names))
+                selected = selected[names.notna().to_numpy() & unseen & ~names.duplicated().to_numpy()]
+                seen_names.update(selected['name'])
+                yield selected
+            print(f"Found in CSV: {found} {group} wines")
+
+        selected_chunks = itertools.chain.from_iterable(chunks(group) for group in WINE_TYPE_GROUPS)
+        all_chunks = parse_chunks(decode_wine_records, selected_chunks, workers)
+        if sync:
+            progress = LoadProgress(action='Synced')
+            result = sync_wines(db.session, all_chunks, progress)
+            progress.finish()
+            print(f"CSV data synced successfully: {result}")
+            return True
+
+        progress = LoadProgress()
+        load_wines(db.session, all_chunks, progress)
+        progress.finish()
         
-        # Commit changes
-        db.session.commit()
         print("CSV data imported successfully!")
         return True
         
     except Exception as e:
         print(f"Error loading wine data from CSV: {e}")
+        db.session.rollback()
+        if not sync:
+            # チャンクごとにコミットしているため、途中まで追加したワインを削除
+            Wine.query.delete()
+            db.session.commit()
         return False
 
-def create_sample_data():
+def create_sample_data(workers=1):
     """Set up the database with sample data for deployment and testing."""
-    with app.app_context():
+    with app_context():
         print("Dropping all tables to ensure clean setup...")
         db.drop_all()
         
@@ -228,7 +224,7 @@ def create_sample_data():
         db.create_all()
         
         # Try to load from CSV first
-        csv_loaded = load_from_csv()
+        csv_loaded = load_from_csv(workers=workers)
         
         # If CSV loading failed, use sample data
         if not csv_loaded:
@@ -305,13 +301,31 @@ def create_sample_data():
         db.session.commit()
         print("Database setup complete with sample data!")
 
+def sync_csv_data(workers=1):
+    """
+    テーブルを削除せず、CSVとの差分のみを反映する（毎日のカタログ更新用）
+    変更のないワインのIDと評価はそのまま残り、CSVからなくなったワインは除外される
+    """
+    with app_context():
+        db.create_all()
+        return load_from_csv(sync=True, workers=workers)
+
 if __name__ == "__main__":
-    create_sample_data()
+    parser = argparse.ArgumentParser(description='Set up the wine database')
+    parser.add_argument('--sync', action='store_true',
+                        help='テーブルを削除せず、CSVとの差分のみを反映する')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='CSVの変換に使うプロセス数（デフォルト: 1）')
+    args = parser.parse_args()
+    if args.sync:
+        sync_csv_data(workers=args.workers)
+    else:
+        create_sample_data(workers=args.workers)
     
 # Export additional function for direct CSV loading
 def load_csv_data():
     """Function to directly load CSV data without dropping tables"""
-    with app.app_context():
+    with app_context():
         # Check if wines already exist
         existing_count = Wine.query.count()
         print(f"Database currently has {existing_count} wines")
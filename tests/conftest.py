@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# テストはリポジトリのルートのモジュール（app.pyなど）をインポートする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.pyのインポート時に作成されるアプリケーション（app:app）がMySQLに接続しようとしないよう、
+# インポートより前にSQLiteのデータベースを指定する
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'wine_test.db'))
+
+from app import create_app  # noqa: E402
+from models import db  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """テストごとのファイルのSQLiteデータベースを使うアプリケーション（テーブル作成済み）"""
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'wine.db'}", 'TESTING': True})
+    with app.app_context():
+        # レプリカを設定したテストが登録したバインドは作成しない（このアプリケーションはプライマリのみ）
+        db.create_all(bind_key=None)
+    yield app
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
@@ -0,0 +1,97 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from sqlalchemy import text
+
+import recommender
+import search_index
+from catalog_events import wine_fingerprint
+from models import db, Wine
+from recommender import recommendation_engine
+from search_index import wine_search_index
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 別のプロセスでワイン名を変更する（件数・最大IDは変わらない）
+RENAME_SCRIPT = """
+from app import create_app
+from models import db, Wine
+app = create_app()
+with app.app_context():
+    Wine.query.filter_by(name='Old Name').one().name = 'New Name'
+    db.session.commit()
+"""
+
+CONVERT_SWEETNESS = """
+from app import convert_sweetness, create_app
+app = create_app()
+with app.app_context():
+    convert_sweetness()
+"""
+
+
+@pytest.fixture
+def database_url(app):
+    with app.app_context():
+        db.session.add_all([Wine(name='Old Name', variety='Merlot', wine_type='赤'),
+                            Wine(name='Other', variety='Syrah', wine_type='赤')])
+        db.session.commit()
+    return app.config['SQLALCHEMY_DATABASE_URI']
+
+
+def run_in_other_process(script, database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True)
+    # リクエストの終了と同じく読み取りのトランザクションを終え、他のプロセスのコミットが見えるようにする
+    db.session.remove()
+
+
+def test_updates_in_other_processes_change_the_fingerprint(app, database_url):
+    with app.app_context():
+        before = wine_fingerprint(db.session)
+        run_in_other_process(RENAME_SCRIPT, database_url)
+        after = wine_fingerprint(db.session)
+    assert after[:2] == before[:2]
+    assert after[2] > before[2]
+
+
+def test_search_index_and_catalog_pick_up_updates_from_other_processes(app, database_url, monkeypatch):
+    monkeypatch.setattr(search_index, 'SYNC_INTERVAL', 0)
+    monkeypatch.setattr(recommender, 'CATALOG_CHECK_INTERVAL', 0)
+    with app.app_context():
+        assert wine_search_index.search(db.session, 'old name')
+        catalog = recommendation_engine.catalog(db.session)
+
+        run_in_other_process(RENAME_SCRIPT, database_url)
+
+        assert wine_search_index.search(db.session, 'old name') == []
+        assert wine_search_index.search(db.session, 'new name')
+        assert recommendation_engine.catalog(db.session).version != catalog.version
+
+
+def test_commits_without_wine_changes_keep_the_version(app, database_url):
+    with app.app_context():
+        before = wine_fingerprint(db.session)
+        db.session.query(Wine).filter(Wine.name == 'Missing').all()
+        db.session.commit()
+        assert wine_fingerprint(db.session) == before
+
+
+def test_sweetness_conversion_in_other_process_changes_the_fingerprint(app, database_url):
+    with app.app_context():
+        # SQLiteではFloat列に文字列の甘さが入りうる（flask convert-sweetnessの変換対象）
+        db.session.execute(text("UPDATE wine SET sweetness = 'SWEET2' WHERE name = 'Other'"))
+        db.session.commit()
+        before = wine_fingerprint(db.session)
+
+        run_in_other_process(CONVERT_SWEETNESS, database_url)
+        converted = wine_fingerprint(db.session)
+        assert converted[2] > before[2]
+        assert Wine.query.filter_by(name='Other').one().sweetness == 2.0
+
+        # 変換するワインがなければバージョンは変わらない
+        run_in_other_process(CONVERT_SWEETNESS, database_url)
+        assert wine_fingerprint(db.session) == converted
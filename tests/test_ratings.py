@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+from sqlalchemy import func
+
+from models import db, Wine, UserPreference, TasteProfile
+from profiles import SUM_COLUMNS, rebuild_profiles
+
+THREADS = 8
+REQUESTS_PER_THREAD = 20
+WINE_COUNT = 10
+DEVICES = ('device-a', 'device-b')
+
+
+@pytest.fixture
+def wines(app):
+    with app.app_context():
+        for i in range(WINE_COUNT):
+            db.session.add(Wine(name=f'Wine {i}', variety='Merlot', wine_type='赤',
+                                acidity=1 + i % 5, tannin=1 + (i + 1) % 5,
+                                body=1 + (i + 2) % 5, sweetness=1 + (i + 3) % 5))
+        db.session.commit()
+        return [wine.id for wine in Wine.query.order_by(Wine.id)]
+
+
+def profile_values(profile):
+    return [getattr(profile, column.key) for column in SUM_COLUMNS.values()] + [profile.total_weight]
+
+
+def run_concurrently(app, request):
+    """
+    THREADS個のスレッドからrequest(client, thread_index, i)をREQUESTS_PER_THREAD回ずつ同時に実行し、
+    失敗した応答（200・404以外）を返す
+    """
+    errors = []
+    start = threading.Barrier(THREADS)
+
+    def send(thread_index):
+        client = app.test_client()
+        start.wait()
+        for i in range(REQUESTS_PER_THREAD):
+            response = request(client, thread_index, i)
+            if response.status_code not in (200, 404):
+                errors.append(response.get_json())
+
+    threads = [threading.Thread(target=send, args=(index,)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def assert_profiles_match_history():
+    """差分で更新したプロファイルが評価履歴からの再計算と一致する（評価がなくなったプロファイルは重み0）"""
+    stored = {profile.device_id: profile_values(profile) for profile in TasteProfile.query if profile.total_weight}
+    rebuild_profiles()
+    rebuilt = {profile.device_id: profile_values(profile) for profile in TasteProfile.query if profile.total_weight}
+    db.session.rollback()
+    assert stored == {device_id: pytest.approx(values) for device_id, values in rebuilt.items()}
+    return stored
+
+
+def rate(client, thread_index, i, wines):
+    # 同じデバイス・同じワインへの評価がスレッド間で重なるようにする
+    return client.post('/rate_wine', json={
+        'device_id': DEVICES[i % len(DEVICES)],
+        'wine_id': wines[(thread_index + i) % len(wines)],
+        'rating': 1 + (thread_index * i) % 5,
+    })
+
+
+def test_concurrent_ratings_keep_rows_unique_and_profiles_consistent(app, wines):
+    errors = run_concurrently(app, lambda client, thread_index, i: rate(client, thread_index, i, wines))
+    assert errors == []
+    with app.app_context():
+        duplicates = db.session.query(UserPreference.device_id, UserPreference.wine_id).group_by(
+            UserPreference.device_id, UserPreference.wine_id
+        ).having(func.count() > 1).all()
+        assert duplicates == []
+        assert set(assert_profiles_match_history()) == set(DEVICES)
+
+
+def test_concurrent_ratings_and_deletes_keep_profiles_consistent(app, wines):
+    def rate_or_delete(client, thread_index, i):
+        if thread_index % 2:
+            return rate(client, thread_index, i, wines)
+        # 評価と同じデバイス・ワインの評価を削除する（まだなければ404）
+        wine_id = wines[(thread_index + 1 + i) % len(wines)]
+        return client.delete(f'/delete_rating/{wine_id}?device_id={DEVICES[i % len(DEVICES)]}')
+
+    errors = run_concurrently(app, rate_or_delete)
+    assert errors == []
+    with app.app_context():
+        assert_profiles_match_history()
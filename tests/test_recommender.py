@@ -0,0 +1,57 @@
+import recommender
+from app import create_app
+from models import db, Wine
+from recommender import recommendation_engine
+
+
+def test_catalog_checks_other_processes_at_most_once_per_interval(app, monkeypatch):
+    calls = []
+
+    def counting_fingerprint(session):
+        calls.append(session)
+        return fingerprint(session)
+
+    fingerprint = recommender.wine_fingerprint
+    monkeypatch.setattr(recommender, 'wine_fingerprint', counting_fingerprint)
+    monkeypatch.setattr(recommender, 'CATALOG_CHECK_INTERVAL', 60)
+    with app.app_context():
+        db.session.add(Wine(name='Wine', variety='Merlot', wine_type='赤'))
+        db.session.commit()
+        catalog = recommendation_engine.catalog(db.session)
+        assert recommendation_engine.catalog(db.session) is catalog
+        assert len(calls) == 1
+
+        # このプロセスでの変更は間隔を待たずに反映する
+        db.session.add(Wine(name='Another', variety='Syrah', wine_type='赤'))
+        db.session.commit()
+        reloaded = recommendation_engine.catalog(db.session)
+        assert reloaded.version != catalog.version
+        assert len(calls) == 2
+
+
+def test_rating_a_wine_without_features_invalidates_cached_recommendations_in_other_workers(app):
+    with app.app_context():
+        db.session.add_all([
+            Wine(name='Complete', variety='Merlot', wine_type='赤', acidity=3, tannin=4, body=4, sweetness=1),
+            Wine(name='Candidate', variety='Syrah', wine_type='赤', acidity=3, tannin=3, body=3, sweetness=2),
+            Wine(name='No Features', variety='Syrah', wine_type='赤'),
+        ])
+        db.session.commit()
+    # 同じデータベースを使う別のワーカー（キャッシュを共有しない）
+    worker = create_app({'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'], 'TESTING': True})
+    writer, reader = app.test_client(), worker.test_client()
+    cache = worker.extensions['wine_app'].recommendation_cache
+
+    assert writer.post('/rate_wine', json={'device_id': 'dev', 'wine_id': 1, 'rating': 5}).status_code == 200
+    assert reader.get('/get_recommendations?device_id=dev').status_code == 200
+    assert reader.get('/get_recommendations?device_id=dev').status_code == 200
+    assert cache.stats()['hits'] == 1
+
+    # 特徴量が揃っていないワインの評価でも品種の好みが変わるため、プロファイルのバージョンが変わる
+    assert writer.post('/rate_wine', json={'device_id': 'dev', 'wine_id': 3, 'rating': 1}).status_code == 200
+    assert reader.get('/get_recommendations?device_id=dev').status_code == 200
+    assert cache.stats()['misses'] == 2
+
+    with worker.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
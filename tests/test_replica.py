@@ -0,0 +1,69 @@
+import sqlite3
+
+import pytest
+
+from app import create_app
+from db_routing import STICKY_COOKIE
+from models import db, Wine
+
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch):
+    """同じプライマリ・レプリカを使う2つのアプリケーションを作るファクトリ（gunicornのワーカープロセスに相当）"""
+    primary, replica = tmp_path / 'primary.db', tmp_path / 'replica.db'
+    monkeypatch.setenv('DATABASE_REPLICA_URL', f'sqlite:///{replica}')
+    monkeypatch.setenv('DATABASE_REPLICA_STICKY_SECONDS', '60')
+    apps = []
+
+    def create_workers(secret_keys):
+        for secret_key in secret_keys:
+            apps.append(create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{primary}', 'TESTING': True,
+                                    'SECRET_KEY': secret_key}))
+        with apps[0].app_context():
+            db.create_all()
+            db.session.add(Wine(name='Wine', variety='Merlot', wine_type='赤',
+                                acidity=3, tannin=3, body=3, sweetness=3))
+            db.session.commit()
+        source, target = sqlite3.connect(primary), sqlite3.connect(replica)
+        source.backup(target)
+        source.close()
+        target.close()
+        return apps
+
+    yield create_workers
+    for app in apps:
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+
+
+def write_and_read(writer, reader):
+    """writerで評価を書き込み、その応答のCookieを付けてreaderで評価履歴を読み取る"""
+    response = writer.test_client().post('/rate_wine', json={'device_id': 'dev', 'wine_id': 1, 'rating': 5})
+    assert response.status_code == 200
+    cookie = response.headers['Set-Cookie']
+    assert cookie.startswith(f'{STICKY_COOKIE}=')
+
+    client = reader.test_client()
+    # Cookieがなければレプリカ（まだ評価が反映されていない）から読み取る
+    assert client.get('/get_rated_wines?device_id=dev').get_json() == []
+    client.set_cookie(STICKY_COOKIE, cookie.split(';')[0].split('=', 1)[1])
+    return client
+
+
+def test_sticky_cookie_keeps_reads_on_the_primary_in_other_workers(workers):
+    writer, reader = workers(['shared-secret', 'shared-secret'])
+    client = write_and_read(writer, reader)
+    # 書き込みの応答のCookieがあれば、別のワーカーでもプライマリから読み取る
+    assert [wine['id'] for wine in client.get('/get_rated_wines?device_id=dev').get_json()] == [1]
+    # 他のデバイスのCookieは使わない
+    assert client.get('/get_rated_wines?device_id=other').get_json() == []
+    assert reader.extensions['wine_app'].replica_router.stats()['primary_reads'] == 1
+
+
+def test_cookies_signed_with_another_key_are_ignored(workers):
+    # SECRET_KEYが未設定の場合はプロセスごとのランダムな鍵になり、他のワーカーのCookieは検証できない
+    writer, reader = workers([None, None])
+    client = write_and_read(writer, reader)
+    assert client.get('/get_rated_wines?device_id=dev').get_json() == []
+    assert reader.extensions['wine_app'].replica_router.stats()['primary_reads'] == 0
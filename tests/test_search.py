@@ -0,0 +1,38 @@
+from datetime import datetime
+
+from models import db, Wine, UserPreference
+from search_index import MAX_PREFIX_SCAN, PrefixIndex, normalize_search_text
+
+
+def test_search_without_active_wines_returns_empty_and_keeps_data(app):
+    with app.app_context():
+        wine = Wine(name='Retired Merlot', variety='Merlot', wine_type='赤', retired_at=datetime.utcnow())
+        db.session.add(wine)
+        db.session.flush()
+        db.session.add(UserPreference(wine_id=wine.id, rating=4, device_id='dev'))
+        db.session.commit()
+
+    response = app.test_client().get('/search_wines_by_name?q=merlot')
+    assert response.status_code == 200
+    assert response.get_json() == []
+    # リクエスト中に初期データを投入しない（評価やワインは削除されない）
+    with app.app_context():
+        assert Wine.query.count() == 1
+        assert UserPreference.query.count() == 1
+
+
+def test_complete_ranks_whole_name_matches_above_crowded_word_matches():
+    index = PrefixIndex()
+    # 「ch」で始まる単語を含むワインが走査の上限より多い
+    for wine_id in range(1, MAX_PREFIX_SCAN + 101):
+        name = f'Grand Chateau {wine_id:04d}'
+        index.add(wine_id, name, normalize_search_text(name), [], sort=False)
+    index.add(0, 'Chianti Classico', normalize_search_text('Chianti Classico'), [], sort=False)
+    index.sort()
+
+    completions = index.complete('ch', 5)
+    assert completions[0] == {'type': 'name', 'id': 0, 'text': 'Chianti Classico'}
+    assert len(completions) == 5
+
+    index.remove(0)
+    assert all(completion['id'] != 0 for completion in index.complete('ch', 5))
@@ -0,0 +1,35 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.pyのインポートにかかる時間の上限（秒）
+IMPORT_TIME_BUDGET = 2.0
+
+# インポート時に読み込まない重いライブラリ
+HEAVY_MODULES = ('pandas', 'sklearn', 'scipy')
+
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+print(json.dumps({'elapsed': elapsed, 'heavy': [name for name in %r if name in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def test_import_is_fast_and_has_no_side_effects(tmp_path):
+    # 新しいプロセスでインポートし、他のテストが読み込んだモジュールの影響を受けないようにする
+    database = tmp_path / 'startup.db'
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{database}')
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+
+    assert result['elapsed'] < IMPORT_TIME_BUDGET
+    assert result['heavy'] == []
+    # インポート時にはデータベースに接続しない（SQLiteのファイルも作成されない）
+    assert not database.exists()
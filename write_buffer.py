@@ -0,0 +1,191 @@
+"""
+評価の書き込みバッファ（グループコミット）
+/rate_wine・/add_preferenceの評価をプロセス内のキューに溜め、一定時間ごとまたは一定件数ごとに
+1つのトランザクションでまとめて保存します。SQLiteで書き込みごとのコミット（fsync）と
+"database is locked"の発生を減らすためのもので、RATING_WRITE_BUFFERで有効にします。
+
+durabilityが'flush'の場合は保存が完了してから応答し、'enqueue'の場合はキューに追加した時点で応答します
+（'enqueue'ではプロセスが異常終了すると未保存の評価が失われます）。
+デバイスの評価を読み取る前にsync_deviceを呼ぶと、そのデバイスの未保存の評価を先に保存します。
+"""
+import atexit
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from models import db
+from ratings import save_ratings
+
+DURABILITY_MODES = ('flush', 'enqueue')
+
+# durability='flush'で保存の完了を待つ最大時間（秒）
+WRITE_TIMEOUT = 30
+
+
+class PendingWrite:
+    """キューに追加した評価の保存結果"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.old_rating = None
+        self.error = None
+
+    def set_result(self, old_rating=None, error=None):
+        self.old_rating = old_rating
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=WRITE_TIMEOUT):
+        """保存の完了を待ち、以前の評価（なければNone）を返す。保存に失敗した場合は例外を送出"""
+        if not self._done.wait(timeout):
+            raise TimeoutError('Rating write was not flushed in time')
+        if self.error is not None:
+            raise self.error
+        return self.old_rating
+
+
+class RatingWriteBuffer:
+    def __init__(self, app, flush_interval=0.05, max_rows=200, durability='flush', on_flush=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Invalid durability: {durability}")
+        self.app = app
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.durability = durability
+        self.on_flush = on_flush      # 保存したデバイスごとに呼び出す（キャッシュの無効化など）
+        self._pending = []            # (device_id, wine_id, rating, rated_at, PendingWrite)
+        self._pending_since = None
+        self._devices = Counter()     # device_id -> 未保存（保存中を含む）の件数
+        self._flush_requested = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        atexit.register(self.flush)
+
+    def write(self, device_id, wine_id, rating):
+        """
+        評価をキューに追加する
+        durability='flush'の場合は保存の完了を待って以前の評価を返し、'enqueue'の場合はすぐにNoneを返す
+        """
+        pending = PendingWrite()
+        with self._cond:
+            self._start()
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.append((device_id, wine_id, rating, datetime.utcnow(), pending))
+            self._devices[device_id] += 1
+            self._cond.notify_all()
+        if self.durability == 'flush':
+            return pending.wait()
+        return None
+
+    def sync_device(self, device_id):
+        """デバイスの未保存の評価があればすぐに保存し、完了を待つ（読み取りの前に呼び出す）"""
+        with self._cond:
+            if not self._devices[device_id]:
+                return
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._devices[device_id]:
+                self._cond.wait()
+
+    def flush(self):
+        """すべての未保存の評価を保存し、完了を待つ"""
+        with self._cond:
+            if not self._devices or self._thread is None:
+                return
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._devices:
+                self._cond.wait()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': sum(self._devices.values()),
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+                'errors': self.errors,
+            }
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='rating-write-buffer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # 最初の評価からflush_interval経過するか、max_rows件溜まるまで待つ
+                deadline = self._pending_since + self.flush_interval
+                while len(self._pending) < self.max_rows and not self._flush_requested:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+                self._flush_requested = False
+
+            self._write(batch)
+
+            with self._cond:
+                for device_id, *_ in batch:
+                    self._devices[device_id] -= 1
+                    if not self._devices[device_id]:
+                        del self._devices[device_id]
+                self._cond.notify_all()
+
+    @staticmethod
+    def _group(batch):
+        """デバイスごとにまとめる（同じワインの評価は後のものを採用）"""
+        devices = {}
+        for device_id, wine_id, rating, rated_at, _ in batch:
+            devices.setdefault(device_id, {})[wine_id] = {'wine_id': wine_id, 'rating': rating, 'rated_at': rated_at}
+        return {device_id: list(ratings.values()) for device_id, ratings in devices.items()}
+
+    def _write(self, batch):
+        devices = self._group(batch)
+        old_ratings = {}
+        errors = {}
+        with self.app.app_context():
+            try:
+                for device_id, ratings in devices.items():
+                    old_ratings[device_id], _ = save_ratings(device_id, ratings)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # まとめての保存に失敗した場合はデバイスごとのトランザクションで保存し直し、
+                # 失敗したデバイスの評価のみエラーにする
+                old_ratings = {}
+                for device_id, ratings in devices.items():
+                    try:
+                        old_ratings[device_id], _ = save_ratings(device_id, ratings)
+                        db.session.commit()
+                    except Exception as e:
+                        db.session.rollback()
+                        errors[device_id] = e
+                        self.app.logger.error(f"Error flushing ratings for device {device_id}: {str(e)}")
+            finally:
+                db.session.remove()
+
+        if self.on_flush is not None:
+            for device_id in old_ratings:
+                self.on_flush(device_id)
+
+        # 同じワインが複数回含まれる場合、後の評価の「以前の評価」は直前の評価
+        current = {device_id: dict(ratings) for device_id, ratings in old_ratings.items()}
+        for device_id, wine_id, rating, _, pending in batch:
+            if device_id in errors:
+                pending.set_result(error=errors[device_id])
+                continue
+            pending.set_result(old_rating=current[device_id].get(wine_id))
+            current[device_id][wine_id] = rating
+
+        with self._cond:
+            self.flushes += 1
+            self.rows_written += sum(len(devices[device_id]) for device_id in old_ratings)
+            self.errors += sum(1 for device_id, *_ in batch if device_id in errors)